@@ -1,23 +1,22 @@
 from __future__ import absolute_import
 
 import sha, md5
-import os
-import tempfile
+import math
+import subprocess
 from datetime import datetime
 import cStringIO as StringIO
 import Image as PIL
+import ImageDraw, ImageFont
 
 from . import EXIF
 from .camera import get_camera
-from .media import Media
+from .media import Media, chunkify, in_transaction
+from .jobqueue import enqueue
 
 ########################################
 # Config - XXX use std config
 #
 
-# ImageMagick "convert"
-convert='/usr/bin/convert'
-
 # IJG jpegtran
 jpegtran='/usr/bin/jpegtran'
 
@@ -30,6 +29,32 @@ fontsize = 12
 #
 ########################################
 
+# PIL transpositions turning a picture anticlockwise by its orientation
+rotations = {  90: PIL.ROTATE_90,
+              180: PIL.ROTATE_180,
+              270: PIL.ROTATE_270 }
+
+def run_jpegtran(data, *args):
+    """ Run jpegtran with args over JPEG data, returning the result,
+        or None if it failed """
+    try:
+        proc = subprocess.Popen([ jpegtran ] + list(args),
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+    except OSError:
+        return None
+    (out, err) = proc.communicate(data)
+    if proc.returncode != 0 or not out:
+        return None
+    return out
+
+def rotate_jpeg(data, angle):
+    """ Losslessly turn JPEG data angle degrees anticlockwise,
+        dropping the Exif (whose orientation would be wrong).  Partial
+        blocks at the edges can't be moved, so they're cut off. """
+    return run_jpegtran(data, '-copy', 'none', '-trim',
+                        '-rotate', str((360 - angle) % 360))
+
 class Image(object):
     _sizes = {
         'icon':         (   75,    75, 1),
@@ -42,8 +67,17 @@ class Image(object):
         'huge':         ( 1600,  1200, 0),
         'full':         (10000, 10000, 0),
         'orig':         (10001, 10001, 0),
+        'orig-rotated': (10001, 10001, 0),
         }
 
+    # sizes which are the original rather than scaled from it
+    _originals = ('orig', 'orig-rotated')
+
+    @staticmethod
+    def watermarked(size):
+        (w, h, sq) = Image._sizes[size]
+        return size not in Image._originals and min(w, h) >= 160
+
     @staticmethod
     def get_sizes():
         ret = [ (k, w, h) for (k,(w,h,sq)) in Image._sizes.items() ]
@@ -64,11 +98,16 @@ class Image(object):
 
 
 class StillImage(Image):
+    _exifbytes = 2 * 65536              # Exif segment is at most 64k, near the start
+    _previewmax = 1024                  # don't look for previews for sizes bigger than this
+    _aspectslop = 0.02                  # how far a preview's shape may be out
+
     def __init__(self, pic, size):
         super(StillImage, self).__init__(pic, size)
 
     def mimetype(self):
-        if self.size == 'orig':
+        if self.size == 'orig' or (self.size == 'orig-rotated' and
+                                   self.pic.orientation == 0):
             return self.pic.mimetype
         else:
             return 'image/jpeg'
@@ -101,95 +140,342 @@ class StillImage(Image):
         else:
             return (int(w * fy), sh)
 
-    def generate(self):
-        """ Generate an image with the appropriate processing,
-            returning a (media, mimetype) tuple.  This will always
-            regenerate the media, so the caller should check to see
-            if something appropriate already exists. """
+    def source(self):
+        """ Return the encoded image data to derive sizes from: an
+            embedded preview if there's one good enough for this size,
+            otherwise the original """
+        data = self.preview()
+        if data is None:
+            data = ''.join(self.pic.chunks('orig'))
+        return data
+
+    def previews(self):
+        """ Return a list of the JPEG previews embedded in the
+            original, smallest first """
+        thumb = self.exif_thumbnail()
+        if thumb is None:
+            return []
+        return [ thumb ]
+
+    def preview(self):
+        """ Return the smallest embedded preview this size can be made
+            from, or None.  It has to be big enough not to need scaling
+            up, and the same shape as the original (some cameras pad
+            thumbnails out to 4:3). """
+        (dw, dh) = self.unrotated()
+        if max(dw, dh) > self._previewmax:
+            return None
 
         p = self.pic
+        for data in self.previews():
+            try:
+                (w, h) = PIL.open(StringIO.StringIO(data)).size
+            except IOError:
+                continue
+            if not self.fits((w, h)):
+                continue
+            if abs(w * p.height - h * p.width) > self._aspectslop * h * p.width:
+                continue
+            return data
+        return None
 
-        # no processing
-        if self.size == 'orig':
-            return (p.media('orig'), p.mimetype)
+    def exif_thumbnail(self):
+        """ Return the JPEG thumbnail embedded in the original's Exif
+            data, or None.  Only the start of the original is read. """
+        m = self.pic.media('orig')
+        if m is None:
+            return None
+
+        head = ''.join(m.byterange(0, min(m.size, self._exifbytes) - 1))
+        try:
+            exif = EXIF.process_file(StringIO.StringIO(head))
+        except Exception:
+            return None
+
+        thumb = exif.get('JPEGThumbnail')
+        if not thumb or not thumb.startswith('\xff\xd8'):
+            return None
+        return thumb
+
+    def placeholder(self):
+        """ Return JPEG data to stand in for this size until it has
+            been made, from the embedded thumbnail, or None """
+        thumb = self.exif_thumbnail()
+        if thumb is None:
+            return None
+
+        sq = Image._sizes[self.size][2]
+        if not sq and self.pic.orientation == 0:
+            return thumb
+
+        try:
+            img = PIL.open(StringIO.StringIO(thumb))
+            if sq:
+                (iw, ih) = img.size
+                side = min(iw, ih)
+                img = img.crop(((iw - side) / 2, (ih - side) / 2,
+                                (iw - side) / 2 + side, (ih - side) / 2 + side))
+            if self.pic.orientation != 0:
+                img = img.transpose(rotations[self.pic.orientation])
+            return self.encode(img)
+        except IOError:
+            return None
+
+    def load(self, procs=None):
+        """ Open the source image, ready to decode.  JPEGs are put in
+            draft mode, so they are scaled down by 1/2, 1/4 or 1/8
+            while decoding when this size (or with procs, every one of
+            theirs) is small enough. """
+        img = PIL.open(StringIO.StringIO(self.source()))
+        if img.format == 'JPEG':
+            drafts = [ p.draftsize(img.size) for p in procs or [ self ] ]
+            img.draft(img.mode, (max([ w for (w, h) in drafts ]),
+                                 max([ h for (w, h) in drafts ])))
+        return img
+
+    def draftsize(self, srcsize):
+        """ Return the smallest size a source of srcsize can be
+            decoded at and still have enough pixels for this size """
+        (w, h) = srcsize
+        (dw, dh) = self.unrotated()
+
+        if Image._sizes[self.size][2]:
+            scale = max(dw, dh) / float(min(w, h))
+        else:
+            scale = max(dw / float(w), dh / float(h))
+
+        if scale >= 1:
+            return (w, h)
+        return (int(math.ceil(w * scale)), int(math.ceil(h * scale)))
+
+    def unrotated(self):
+        """ Return the dimensions of this size before rotation """
+        (dw, dh) = self.dimensions()
+        if self.pic.orientation in (90, 270):
+            (dw, dh) = (dh, dw)
+        return (dw, dh)
+
+    def fits(self, srcsize):
+        """ Return true if this size can be scaled down from an
+            unrotated image of srcsize """
+        (w, h) = srcsize
+        (dw, dh) = self.unrotated()
+        if Image._sizes[self.size][2]:
+            return min(w, h) >= dw
+        return w >= dw and h >= dh
+
+    def scale(self, img):
+        """ Crop and scale unrotated img to this size """
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+
+        (dw, dh) = self.unrotated()
+
+        if Image._sizes[self.size][2]:
+            (iw, ih) = img.size
+            side = min(iw, ih)
+            img = img.crop(((iw - side) / 2, (ih - side) / 2,
+                            (iw - side) / 2 + side, (ih - side) / 2 + side))
+            if dw != dh:
+                # original smaller than the square; leave it be
+                (dw, dh) = img.size
+
+        if (dw, dh) != img.size:
+            img = img.resize((dw, dh), PIL.ANTIALIAS)
+
+        return img
+
+    def finish(self, img):
+        """ Rotate and watermark a scaled img """
+        p = self.pic
+
+        if p.orientation != 0:
+            img = img.transpose(rotations[p.orientation])
+
+        if Image.watermarked(self.size):
+            img = self.watermark(img)
+
+        return img
+
+    def derive(self, img):
+        """ Crop, scale, rotate and watermark img for this size """
+        return self.finish(self.scale(img))
+
+    def watermark(self, img):
+        """ Put the picture number and copyright in the bottom left
+            corner, white on a translucent black box """
+        p = self.pic
 
         (w, h, sq) = Image._sizes[self.size]
         short = min(w,h) < 400
 
-        args = []
+        def text(s):
+            if isinstance(s, str):
+                s = s.decode('utf-8', 'replace')
+            return s
 
-        # Strip all Exif
-        args.append('-strip')
-
-        if sq:
-            maxdim = max(p.width, p.height)
-            mindim = min(p.width, p.height)
-            
-            if p.width > p.height:
-                args.append('-extract %dx%d+%d+0' % (p.height, p.height,
-                                                     (p.width - p.height)/2))
-            else:
-                args.append('-extract %dx%d+0+%d' % (p.width, p.width,
-                                                     (p.height - p.width)/2))
-
-        # Then scale down
-        if w < p.width or h < p.height:
-            if p.orientation in (90, 270):
-                args.append('-size %(w)dx%(h)d -resize %(w)dx%(h)d' % { 'w': h, 'h': w })
-            else:
-                args.append('-size %(w)dx%(h)d -resize %(w)dx%(h)d' % { 'w': w, 'h': h })
-
-        copyright = p.copyright
+        copyright = text(p.copyright)
 
         if not copyright:
-            copyright = '\xa9%s %s' % (p.created_time.strftime('%Y'),
-                                       (p.photographer or p.owner).email)
-            if not short:
-                'Copyright '+copyright
+            copyright = u'\xa9%s %s' % (p.created_time.strftime('%Y'),
+                                        text((p.photographer or p.owner).email))
 
-        brand = 'PackRat '
+        brand = u'PackRat '
         fontsz = fontsize
         
         if short:
-            brand = ''
+            brand = u''
             fontsz = fontsz * .75
 
-        # watermark
-        if min(w,h) >= 160:
-            args.append('-box "#00000070" -fill white '
-                        '-pointsize %(size)d -font %(font)s -encoding Unicode '
-                        '-draw "gravity SouthWest text 4,4 \\"%(brand)s#%(id)d %(copy)s\\"" '
-                        '-quality %(qual)d' % {
-                'font': font,
-                'size': fontsz,
-                'id': p.id,
-                'qual': jpeg_quality,
-                'copy': copyright,
-                'brand': brand,
-                })
-
-        # Rotate
-        if p.orientation != 0:
-            args.append('-rotate %d' % -p.orientation)
+        try:
+            f = ImageFont.truetype(font, int(fontsz))
+        except IOError:
+            f = ImageFont.load_default()
+
+        label = u'%s#%d %s' % (brand, p.id, copyright)
+        (tw, th) = f.getsize(label)
+        (x, y) = (4, img.size[1] - 4 - th)
+
+        overlay = PIL.new('RGBA', img.size, (0, 0, 0, 0))
+        draw = ImageDraw.Draw(overlay)
+        draw.rectangle((x - 1, y - 1, x + tw + 1, y + th + 1), fill=(0, 0, 0, 0x70))
+        draw.text((x, y), label, font=f, fill=(255, 255, 255, 255))
+        del draw
+
+        img = img.convert('RGB')
+        img.paste(overlay, None, overlay)
+        return img
+
+    def encode(self, img):
+        """ Return img as JPEG data, without any Exif """
+        out = StringIO.StringIO()
+        img.save(out, 'JPEG', quality=jpeg_quality)
+        return out.getvalue()
+
+    def rotate_orig(self):
+        """ Store the original turned the right way up, losslessly
+            with jpegtran if it's a JPEG (less any partial blocks at
+            the edges), otherwise decoded, turned and re-encoded """
+        p = self.pic
 
-        tmp = tempfile.NamedTemporaryFile(mode='wb', suffix='.%s' % self.extension)
-        for c in p.chunks('orig'):
-            tmp.write(c)
-        tmp.flush()
+        data = None
+        if p.mimetype == 'image/jpeg':
+            data = rotate_jpeg(''.join(p.chunks('orig')), p.orientation)
+
+        if data is None:
+            img = self.load()
+            if img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB')
+            data = self.encode(img.transpose(rotations[p.orientation]))
+
+        return Media.store(p.mediakey(self.size), data, cache=True)
+
+    def generate(self):
+        """ Generate an image with the appropriate processing,
+            returning a (media, mimetype) tuple.  This will always
+            regenerate the media, so the caller should check to see
+            if something appropriate already exists.  It's all done
+            in memory with PIL. """
+
+        p = self.pic
+
+        # no processing
+        if self.size == 'orig' or (self.size == 'orig-rotated' and
+                                   p.orientation == 0):
+            return (p.media('orig'), p.mimetype)
 
-        cmd = '%s %s %s jpg:-' % (convert, ' '.join(args), tmp.name)
-        #print 'cmd=%s' % cmd
-        result = os.popen(cmd)
+        if self.size == 'orig-rotated':
+            return (self.rotate_orig(), 'image/jpeg')
 
-        data = ''.join(result)
-        m = Media.store(p.mediakey(self.size), data, cache=True)
+        img = self.derive(self.load())
+        m = Media.store(p.mediakey(self.size), self.encode(img), cache=True)
 
-        return (m, 'image/jpg')
+        return (m, 'image/jpeg')
         
+def tiff_jpegs(f):
+    """ Return a list of (offset, length) of the JPEG images embedded
+        in a TIFF-structured file (such as a NEF), found in its IFDs
+        and their SubIFDs """
+    f.seek(0)
+    hdr = EXIF.EXIF_header(f, f.read(1), 0, 0)
+
+    def value(entry):
+        # first value of an IFD entry, which is in the entry if it fits
+        (type, count) = (hdr.s2n(entry + 2, 2), hdr.s2n(entry + 4, 4))
+        if type == 13:                  # IFD, which EXIF doesn't know
+            size = 4
+        elif 0 < type < len(EXIF.FIELD_TYPES):
+            size = EXIF.FIELD_TYPES[type][0]
+        else:
+            raise ValueError('unknown field type %d' % type)
+        offset = entry + 8
+        if size * count > 4:
+            offset = hdr.s2n(offset, 4)
+        return (offset, size, count)
+
+    ret = []
+    todo = hdr.list_IFDs()
+    seen = set()
+    while todo:
+        ifd = todo.pop(0)
+        if ifd in seen:
+            continue
+        seen.add(ifd)
+
+        tags = {}
+        for i in range(hdr.s2n(ifd, 2)):
+            entry = ifd + 2 + 12 * i
+            tags[hdr.s2n(entry, 2)] = entry
+
+        if 0x014A in tags:              # SubIFDs
+            (offset, size, count) = value(tags[0x014A])
+            todo.extend([ hdr.s2n(offset + size * i, size) for i in range(count) ])
+
+        if 0x0201 in tags and 0x0202 in tags:
+            (offset, size, count) = value(tags[0x0201])
+            start = hdr.s2n(offset, size)
+            (offset, size, count) = value(tags[0x0202])
+            ret.append((start, hdr.s2n(offset, size)))
+
+    return ret
+
 class RawStillImage(StillImage):
+    """ Camera raw files, which PIL can't decode.  Sizes are made
+        from the JPEG previews the camera embeds instead, the biggest
+        (usually full size) standing in for the original. """
+
     def __init__(self, pic, size):
         super(RawStillImage, self).__init__(pic, size)
 
+    def previews(self):
+        """ Generate the embedded JPEGs, smallest first, reading only
+            as much of the original as it takes """
+        m = self.pic.media('orig')
+        if m is None:
+            return
+
+        f = m.open()
+        try:
+            found = tiff_jpegs(f)
+        except (ValueError, IndexError, KeyError, IOError):
+            return
+        found.sort(lambda a,b: cmp(a[1], b[1]))
+
+        for (offset, length) in found:
+            f.seek(offset)
+            data = f.read(length)
+            if data.startswith('\xff\xd8'):
+                yield data
+
+    def source(self):
+        data = self.preview()
+        if data is None:
+            for data in self.previews():
+                pass
+        if data is None:
+            data = ''.join(self.pic.chunks('orig'))
+        return data
+
 class VideoImage(Image):
     def __init__(self, pic, size):
         super(VideoStillImage, self).__init__(pic, size)
@@ -209,13 +495,96 @@ def ImageProcessor(pic, size):
 
     return mimetypes[pic.mimetype][1](pic, size)
     
-def sniff_mimetype(file):
+def generate_all(pic, sizes=None):
+    """ Generate several sizes of pic at once, returning a dict
+        mapping size to media.  The source is decoded once, for the
+        largest size, and each smaller size is scaled from the
+        smallest unwatermarked result so far which is big enough.
+        sizes defaults to everything not already stored. """
+    if sizes is None:
+        have = [ m.variant for m in pic.variants()
+                 if m.orientation == pic.orientation ]
+        sizes = [ s for (s, w, h) in Image.get_sizes()
+                  if s not in Image._originals and s not in have ]
+
+    procs = [ ImageProcessor(pic, s) for s in sizes if s not in Image._originals ]
+    procs = [ p for p in procs if p is not None ]
+    if not procs:
+        return {}
+
+    # largest first, squares after the rest
+    procs.sort(lambda a,b: cmp(Image._sizes[a.size][2], Image._sizes[b.size][2]) or
+               cmp(b.unrotated()[0] * b.unrotated()[1],
+                   a.unrotated()[0] * a.unrotated()[1]))
+
+    img = procs[0].load(procs)
+
+    # unwatermarked, unrotated images to scale from, largest first
+    pool = [ img ]
+    ret = {}
+    for proc in procs:
+        fit = [ i for i in pool if proc.fits(i.size) ]
+        if fit:
+            src = fit[-1]
+        else:
+            src = pool[0]
+
+        scaled = proc.scale(src)
+        if not Image._sizes[proc.size][2]:
+            pool.append(scaled)
+
+        out = proc.encode(proc.finish(scaled))
+        ret[proc.size] = Media.store(pic.mediakey(proc.size), out, cache=True)
+
+    return ret
+
+def reorient(pic, old):
+    """ Queue the sizes of pic stored for its old orientation to be
+        made again, from the original, for its new one.  Turning them
+        instead would lose a little more each time (the small ones are
+        never whole JPEG blocks, so not even jpegtran can turn them
+        losslessly), and would put a watermark in the wrong corner.
+        Without a queue they are made as they are asked for. """
+    if (pic.orientation - old) % 360 == 0:
+        return
+
+    stored = pic.variants()
+    have = [ m.variant for m in stored if m.orientation == pic.orientation ]
+    sizes = [ m.variant for m in stored
+              if m.orientation == old and m.variant in Image._sizes and
+              m.variant not in Image._originals and m.variant not in have ]
+    if sizes:
+        enqueue(pic, sizes)
+
+def is_nef(file):
+    """ Return true if the TIFF in file is a Nikon raw file: made by a
+        Nikon, with JPEG previews embedded (unlike a Nikon scanner's) """
+    file.seek(0)
+    try:
+        make = EXIF.process_file(file).get('Image Make')
+        if make is None or not str(make.printable).upper().startswith('NIKON'):
+            return False
+        for (offset, length) in tiff_jpegs(file):
+            file.seek(offset)
+            if file.read(2) == '\xff\xd8':
+                return True
+    except Exception:
+        pass
+    return False
+
+def sniff_mimetype(file, filename=None):
     file.seek(0)
     try:
         img = PIL.open(file)
-        return PIL.MIME[img.format]
+        mimetype = PIL.MIME[img.format]
     except IOError:
-        return None
+        mimetype = None
+
+    # PIL sees a raw file as a TIFF (of its small thumbnail), if at all
+    if mimetype in (None, 'image/tiff'):
+        if (filename or '').lower().endswith('.nef') or is_nef(file):
+            mimetype = 'image/vnd.nikon.nef'
+    return mimetype
 
 class ImportError(Exception):
     def __init__(self, msg):
@@ -229,8 +598,10 @@ def register_importer(mimetype, importer):
 def importer(file, **kwargs):
     mimetype = kwargs.get('mimetype')
 
-    if mimetype is None or mimetype not in importers:
-        mimetype = sniff_mimetype(file)
+    # raw files tend to be sent as TIFFs, or with a type of their own
+    # (image/x-nikon-nef) or none (application/octet-stream)
+    if mimetype is None or mimetype not in importers or mimetype == 'image/tiff':
+        mimetype = sniff_mimetype(file, kwargs.get('original_ref'))
         if mimetype is None:
             mimetype = 'application/binary'  # ?
 
@@ -253,16 +624,37 @@ def still_image_importer(file, mimetype, owner, visibility, camera = None,
     file.seek(0)
     img = PIL.open(file)
 
+    # Hash the data a chunk at a time rather than reading it all in
     file.seek(0)
-    data = file.read()
+    md5sum = md5.new()
+    sha1sum = sha.new()
+    datasize = 0
+    for c in chunkify(file, Media._chunksize):
+        md5sum.update(c)
+        sha1sum.update(c)
+        datasize += len(c)
 
-    md5hash = md5.new(data).digest().encode('hex')
+    md5hash = md5sum.digest().encode('hex')
 
     if sha1hash is None:
-        sha1hash = sha.new(data).digest().encode('hex')
+        sha1hash = sha1sum.digest().encode('hex')
 
     width,height = img.size
 
+    # What PIL sees of a raw file is a small thumbnail; the biggest
+    # embedded preview gives its real size
+    if mimetype in mimetypes and issubclass(mimetypes[mimetype][1], RawStillImage):
+        try:
+            previews = tiff_jpegs(file)
+            if previews:
+                (offset, length) = max(previews, key=lambda p: p[1])
+                file.seek(offset)
+                data = file.read(length)
+                if data.startswith('\xff\xd8'):
+                    width,height = PIL.open(StringIO.StringIO(data)).size
+        except (ValueError, IndexError, KeyError, IOError):
+            pass                        # keep what PIL saw
+
     if camera is None:
         camera = get_camera(owner, exif)
 
@@ -285,33 +677,44 @@ def still_image_importer(file, mimetype, owner, visibility, camera = None,
         except KeyError:
             pass
     
-    p = Picture(sha1hash = sha1hash,
-                md5hash = md5hash,
-                width=width, height=height,
-                datasize = len(data),
-                mimetype = mimetype,
-                owner = owner,
-                visibility = visibility,
-                camera = camera,
-                created_time = created_time,
-                created_time_us = created_time.microsecond,
-                orientation = orientation,
-                **kwargs)
-    p.save()
-
-    try:
-        m = Media.store(p.mediakey('orig'), data, sha1hash)
-    except Exception, e:
-        p.delete()
-        raise e
-
-    if tags:
-        p.addtags(tags)
+    # Create the picture, its media and tags in a single transaction,
+    # so that a failure part way through leaves nothing behind (the
+    # tables are made InnoDB by sql/ for this)
+    @in_transaction
+    def create():
+        p = Picture(sha1hash = sha1hash,
+                    md5hash = md5hash,
+                    width=width, height=height,
+                    datasize = datasize,
+                    mimetype = mimetype,
+                    owner = owner,
+                    visibility = visibility,
+                    camera = camera,
+                    created_time = created_time,
+                    created_time_us = created_time.microsecond,
+                    orientation = orientation,
+                    **kwargs)
+        p.save()
+
+        file.seek(0)
+        Media.store(p.mediakey('orig'), file, sha1hash)
+
+        if tags:
+            p.add_tags(tags)
+
+        return p
+
+    p = create()
+
+    # If the caller's transaction hasn't committed yet, the worker
+    # won't find the picture, and waits for it
+    enqueue(p)
 
     return p
 
 PIL.init()                            # load all codecs
 for t in [ v for v in PIL.MIME.values() if v.startswith('image/') ]:
     register_importer(t, still_image_importer)
+register_importer('image/vnd.nikon.nef', still_image_importer)
 
-__all__ = [ 'importer', 'ImageProcessor' ]
+__all__ = [ 'importer', 'ImageProcessor', 'generate_all', 'reorient' ]
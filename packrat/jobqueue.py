@@ -0,0 +1,223 @@
+from __future__ import absolute_import
+
+import os
+import time
+import threading
+
+try:
+    import sqlite3
+except ImportError:
+    from pysqlite2 import dbapi2 as sqlite3
+
+from django.conf import settings
+
+class JobQueue(object):
+    """ Persistent queue of derived sizes waiting to be generated,
+        kept in a local SQLite database so that several worker
+        processes can share it and nothing is lost over a restart.
+
+        Each job is one size of one picture.  Workers take all the
+        waiting sizes of a picture with the same priority at once, so
+        they can be made from a single decode of the original.  Jobs
+        which fail are retried a few times, backing off, and then left
+        marked as failed.  Jobs for a picture whose upload hasn't been
+        committed yet just wait for it, for up to _maxwait.  Finished
+        jobs are logged for a day so that throughput can be reported. """
+
+    __slots__ = [ 'path', 'local' ]
+
+    _maxtries = 3
+    _backoff = 60                       # seconds before the first retry
+    _recheck = 5                        # seconds between looks for a new picture
+    _maxwait = 30 * 60                  # seconds an upload may take to commit
+    _keeplog = 24 * 60 * 60             # seconds to keep finished jobs
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def db(self):
+        # SQLite connections can't be shared between threads (or
+        # processes), and transactions are managed by hand
+        db = getattr(self.local, 'db', None)
+        if db is None or self.local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.text_factory = str
+            db.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                       ' pictureid INTEGER NOT NULL,'
+                       ' size TEXT NOT NULL,'
+                       ' priority INTEGER NOT NULL,'
+                       ' state TEXT NOT NULL,'
+                       ' tries INTEGER NOT NULL DEFAULT 0,'
+                       ' queued_time REAL NOT NULL,'
+                       ' not_before REAL NOT NULL DEFAULT 0,'
+                       ' worker INTEGER,'
+                       ' error TEXT,'
+                       ' PRIMARY KEY (pictureid, size))')
+            db.execute('CREATE INDEX IF NOT EXISTS jobs_next'
+                       ' ON jobs (state, priority, queued_time)')
+            db.execute('CREATE TABLE IF NOT EXISTS finished ('
+                       ' pictureid INTEGER NOT NULL,'
+                       ' size TEXT NOT NULL,'
+                       ' finish_time REAL NOT NULL,'
+                       ' elapsed REAL NOT NULL)')
+            db.execute('CREATE INDEX IF NOT EXISTS finished_time'
+                       ' ON finished (finish_time)')
+            self.local.db = db
+            self.local.pid = os.getpid()
+        return db
+
+    def transact(self, fn, *args):
+        """ Run fn(db, *args) holding the database's write lock """
+        db = self.db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            ret = fn(db, *args)
+        except:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+        return ret
+
+    def put(self, pictureid, sizes):
+        """ Queue sizes of a picture; sizes is a list of (size,
+            priority), lowest priority first.  Sizes already waiting
+            are left where they are, and failed ones get another go. """
+        now = time.time()
+        def put(db):
+            for (size, pri) in sizes:
+                db.execute('INSERT OR IGNORE INTO jobs'
+                           ' (pictureid, size, priority, state, queued_time)'
+                           ' VALUES (?, ?, ?, ?, ?)',
+                           (pictureid, size, pri, 'queued', now))
+                db.execute('UPDATE jobs SET state = ?, tries = 0, not_before = 0'
+                           ' WHERE pictureid = ? AND size = ? AND state = ?',
+                           ('queued', pictureid, size, 'failed'))
+        self.transact(put)
+
+    def take(self, worker):
+        """ Claim the most urgent waiting work for worker, returning
+            (pictureid, [ sizes ]), or None if there is nothing to do """
+        now = time.time()
+        def take(db):
+            r = db.execute('SELECT pictureid, priority FROM jobs'
+                           ' WHERE state = ? AND not_before <= ?'
+                           ' ORDER BY priority, queued_time LIMIT 1',
+                           ('queued', now)).fetchone()
+            if r is None:
+                return None
+            (pictureid, pri) = r
+            sizes = [ s for (s,) in db.execute('SELECT size FROM jobs'
+                                               ' WHERE pictureid = ? AND priority = ?'
+                                               ' AND state = ?',
+                                               (pictureid, pri, 'queued')) ]
+            db.execute('UPDATE jobs SET state = ?, worker = ?'
+                       ' WHERE pictureid = ? AND priority = ? AND state = ?',
+                       ('running', worker, pictureid, pri, 'queued'))
+            return (pictureid, sizes)
+        return self.transact(take)
+
+    def done(self, pictureid, sizes, elapsed):
+        now = time.time()
+        def done(db):
+            for s in sizes:
+                db.execute('DELETE FROM jobs WHERE pictureid = ? AND size = ?',
+                           (pictureid, s))
+                db.execute('INSERT INTO finished (pictureid, size, finish_time, elapsed)'
+                           ' VALUES (?, ?, ?, ?)', (pictureid, s, now, elapsed))
+            db.execute('DELETE FROM finished WHERE finish_time < ?',
+                       (now - self._keeplog,))
+        self.transact(done)
+
+    def fail(self, pictureid, sizes, error):
+        """ Put the jobs back to be retried later, or mark them failed
+            once they've been tried often enough """
+        now = time.time()
+        def fail(db):
+            for s in sizes:
+                db.execute('UPDATE jobs SET tries = tries + 1, error = ?, worker = NULL'
+                           ' WHERE pictureid = ? AND size = ?', (error, pictureid, s))
+                db.execute('UPDATE jobs SET state = ? WHERE pictureid = ? AND size = ?'
+                           ' AND tries >= ?', ('failed', pictureid, s, self._maxtries))
+                db.execute('UPDATE jobs SET state = ?, not_before = ? + ? * tries'
+                           ' WHERE pictureid = ? AND size = ? AND tries < ?',
+                           ('queued', now, self._backoff, pictureid, s, self._maxtries))
+        self.transact(fail)
+
+    def wait(self, pictureid, sizes, error):
+        """ Put the jobs back to be looked at again shortly, without
+            counting a try, because their picture isn't there yet: the
+            transaction adding it may not have committed.  Once they
+            have been queued for _maxwait it's taken to have been
+            rolled back, and they're marked failed. """
+        now = time.time()
+        def wait(db):
+            for s in sizes:
+                db.execute('UPDATE jobs SET state = ?, not_before = ?, error = ?, worker = NULL'
+                           ' WHERE pictureid = ? AND size = ? AND queued_time > ?',
+                           ('queued', now + self._recheck, error, pictureid, s,
+                            now - self._maxwait))
+                db.execute('UPDATE jobs SET state = ?, error = ?, worker = NULL'
+                           ' WHERE pictureid = ? AND size = ? AND queued_time <= ?',
+                           ('failed', error, pictureid, s, now - self._maxwait))
+        self.transact(wait)
+
+    def release(self, worker):
+        """ Put back anything worker had claimed, after it died """
+        def release(db):
+            db.execute('UPDATE jobs SET state = ?, worker = NULL'
+                       ' WHERE state = ? AND worker = ?', ('queued', 'running', worker))
+        self.transact(release)
+
+    def retry(self):
+        """ Give all failed jobs another go """
+        def retry(db):
+            db.execute('UPDATE jobs SET state = ?, tries = 0, not_before = 0'
+                       ' WHERE state = ?', ('queued', 'failed'))
+        self.transact(retry)
+
+    def depth(self):
+        """ Return a list of (size, state, count, oldest queued_time) """
+        return self.db().execute('SELECT size, state, COUNT(*), MIN(queued_time)'
+                                 ' FROM jobs GROUP BY priority, size, state'
+                                 ' ORDER BY priority, size, state').fetchall()
+
+    def throughput(self, period):
+        """ Return (jobs, mean seconds per job) finished in the last
+            period seconds """
+        return self.db().execute('SELECT COUNT(*), AVG(elapsed) FROM finished'
+                                 ' WHERE finish_time >= ?',
+                                 (time.time() - period,)).fetchone()
+
+    def failures(self, limit=20):
+        """ Return a list of (pictureid, size, tries, error) """
+        return self.db().execute('SELECT pictureid, size, tries, error FROM jobs'
+                                 ' WHERE state = ? ORDER BY queued_time DESC LIMIT ?',
+                                 ('failed', limit)).fetchall()
+
+_queue = None
+
+def get_queue():
+    """ Return the queue given by PACKRAT_JOBQUEUE, or None if there
+        isn't one """
+    global _queue
+    if _queue is None and settings.PACKRAT_JOBQUEUE:
+        _queue = JobQueue(settings.PACKRAT_JOBQUEUE)
+    return _queue
+
+def enqueue(pic, sizes=None):
+    """ Queue sizes of a picture to be made, by default those in
+        PACKRAT_PREGENERATE, if there's a queue.  Returns whether
+        there was. """
+    q = get_queue()
+    if q is None:
+        return False
+
+    groups = settings.PACKRAT_PREGENERATE
+    pri = dict([ (s, n) for (n, group) in enumerate(groups) for s in group ])
+    if sizes is None:
+        sizes = pri.keys()
+    q.put(pic.id, [ (s, pri.get(s, len(groups))) for s in sizes ])
+    return True
+
+__all__ = [ 'JobQueue', 'get_queue', 'enqueue' ]
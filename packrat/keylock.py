@@ -0,0 +1,76 @@
+from __future__ import absolute_import
+
+import os
+import sha
+import time
+import fcntl
+import tempfile
+
+from django.conf import settings
+
+class KeyLock(object):
+    """ Exclusive lock on some media keys, shared by every process
+        (and thread) on the host, so that only one of them generates a
+        given media at a time while the rest wait for it.
+
+        Keys are hashed onto a fixed set of lock files under
+        PACKRAT_LOCK_DIR, which are flock()ed; there's nothing to
+        clean up, and the kernel drops the locks of a process which
+        dies.  Two keys occasionally share a lock file, which just
+        means they're made one after the other. """
+
+    __slots__ = [ 'stripes', 'fds' ]
+
+    _nstripes = 1024
+    _poll = 0.05                        # seconds between tries
+
+    def __init__(self, keys):
+        if isinstance(keys, basestring):
+            keys = [ keys ]
+
+        # always lock in the same order, so two lockers can't deadlock
+        stripes = set([ int(sha.new(k).hexdigest()[:8], 16) % self._nstripes
+                        for k in keys ])
+        self.stripes = sorted(stripes)
+        self.fds = []
+
+    def lockdir(self):
+        d = settings.PACKRAT_LOCK_DIR
+        if not d:
+            d = os.path.join(tempfile.gettempdir(), 'packrat-locks')
+        if not os.path.isdir(d):
+            try:
+                os.makedirs(d)
+            except OSError:
+                if not os.path.isdir(d):
+                    raise
+        return d
+
+    def acquire(self, timeout=None):
+        """ Wait up to timeout seconds (forever if None) for the lock,
+            returning whether we got it """
+        d = self.lockdir()
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        for s in self.stripes:
+            fd = os.open(os.path.join(d, '%03x.lock' % s), os.O_RDWR | os.O_CREAT, 0666)
+            self.fds.append(fd)
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except IOError:
+                    if timeout is not None and time.time() >= deadline:
+                        self.release()
+                        return False
+                    time.sleep(self._poll)
+        return True
+
+    def release(self):
+        for fd in self.fds:
+            # closing drops the lock
+            os.close(fd)
+        self.fds = []
+
+__all__ = [ 'KeyLock' ]
@@ -0,0 +1,91 @@
+from __future__ import absolute_import
+
+import time
+import threading
+
+class LRUCache(object):
+    """ Thread-safe mapping which holds at most maxsize entries,
+        discarding the least recently used when full.  Entries older
+        than ttl seconds are treated as missing. """
+
+    __slots__ = [ 'maxsize', 'ttl', 'lock', 'map', 'head' ]
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.map = {}
+
+        # Circular doubly-linked list of [prev, next, key, value, time],
+        # most recently used next to head
+        self.head = [ None, None, None, None, None ]
+        self.head[0] = self.head[1] = self.head
+
+    def _unlink(self, node):
+        node[0][1] = node[1]
+        node[1][0] = node[0]
+
+    def _push(self, node):
+        head = self.head
+        node[0] = head
+        node[1] = head[1]
+        head[1][0] = node
+        head[1] = node
+
+    def get(self, key, default=None):
+        self.lock.acquire()
+        try:
+            node = self.map.get(key)
+            if node is None:
+                return default
+
+            if self.ttl is not None and time.time() - node[4] > self.ttl:
+                self._unlink(node)
+                del self.map[key]
+                return default
+
+            self._unlink(node)
+            self._push(node)
+            return node[3]
+        finally:
+            self.lock.release()
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+
+        self.lock.acquire()
+        try:
+            node = self.map.get(key)
+            if node is not None:
+                self._unlink(node)
+            node = [ None, None, key, value, time.time() ]
+            self.map[key] = node
+            self._push(node)
+
+            while len(self.map) > self.maxsize:
+                old = self.head[0]
+                self._unlink(old)
+                del self.map[old[2]]
+        finally:
+            self.lock.release()
+
+    def remove(self, key):
+        self.lock.acquire()
+        try:
+            node = self.map.pop(key, None)
+            if node is not None:
+                self._unlink(node)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.map = {}
+            self.head[0] = self.head[1] = self.head
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return len(self.map)
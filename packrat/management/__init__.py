@@ -0,0 +1,31 @@
+from __future__ import absolute_import
+
+import time
+import threading
+
+class Throttle(object):
+    """ Limit on the number of bytes per second a background job
+        works through, shared by all its threads, so that it can run
+        against a live site. """
+
+    __slots__ = [ 'rate', 'lock', 'next' ]
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next = time.time()
+
+    def consume(self, nbytes):
+        if not self.rate:
+            return
+
+        self.lock.acquire()
+        try:
+            now = time.time()
+            start = max(self.next, now)
+            self.next = start + nbytes / self.rate
+        finally:
+            self.lock.release()
+
+        if start > now:
+            time.sleep(start - now)
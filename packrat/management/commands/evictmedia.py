@@ -0,0 +1,84 @@
+from __future__ import absolute_import
+
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.db import connection
+from django.db import backend as dbbackend
+
+from ...media import Media, MediaError
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--budget', type='int', default=None,
+                    help='Bytes of cached media to keep (default '
+                    'settings.PACKRAT_CACHE_BUDGET)'),
+        make_option('--policy', default='lru', choices=('lru', 'lfu'),
+                    help='Evict least recently used (lru) or least '
+                    'frequently used (lfu) media first'),
+        make_option('--batch', type='int', default=100,
+                    help='Number of media considered at a time'),
+        make_option('--dry-run', action='store_true', dest='dryrun', default=False,
+                    help="Report what would be evicted, but don't"),
+        )
+    help = ('Evict cached derived images until their total size is within '
+            'budget.  Originals are never evicted.')
+
+    def handle(self, *args, **options):
+        budget = options['budget']
+        if budget is None:
+            budget = settings.PACKRAT_CACHE_BUDGET
+        if budget < 0:
+            raise CommandError('budget must not be negative')
+
+        if options['policy'] == 'lru':
+            order = ('access_time', 'hits', 'id')
+        else:
+            order = ('hits', 'access_time', 'id')
+
+        total = self.cached_bytes()
+        print 'cache holds %d bytes, budget %d' % (total, budget)
+
+        evicted = 0
+        failed = 0
+        freed = 0
+        while total > budget:
+            query = Media.objects.filter(cache=True).exclude(key__endswith='/orig')
+            query = query.order_by(*order)
+
+            # evicted media drop out of the query; when only
+            # pretending, skip over them instead, as well as any
+            # which couldn't be evicted
+            start = failed
+            if options['dryrun']:
+                start += evicted
+            batch = list(query[start:start + options['batch']])
+            if not batch:
+                break
+
+            for m in batch:
+                if total <= budget:
+                    break
+                if not options['dryrun']:
+                    try:
+                        m.purge()
+                    except (MediaError, OSError, IOError), e:
+                        sys.stderr.write('media %d (%s): %s\n' % (m.id, m.key, e))
+                        failed += 1
+                        continue
+                total -= m.size
+                freed += m.size
+                evicted += 1
+
+        print 'evicted %d media, %d bytes; cache now %d bytes' % (evicted, freed, total)
+
+    def cached_bytes(self):
+        opts = Media._meta
+        qn = dbbackend.quote_name
+        cursor = connection.cursor()
+        cursor.execute('SELECT SUM(%s) FROM %s WHERE %s = %%s' %
+                       (qn(opts.get_field('size').column), qn(opts.db_table),
+                        qn(opts.get_field('cache').column)), [ True ])
+        return int(cursor.fetchone()[0] or 0)
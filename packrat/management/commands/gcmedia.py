@@ -0,0 +1,174 @@
+from __future__ import absolute_import
+
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db import backend as dbbackend
+
+from ...media import Media, MediaChunk, MediaError, FileMediaBackend, get_backend
+from ...picture import Picture
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--batch', type='int', default=500,
+                    help='Number of media considered at a time'),
+        make_option('--grace', type='float', default=60,
+                    help='Leave anything written in the last this many minutes, '
+                    'in case it belongs to an upload or edit in progress'),
+        make_option('--keep-originals', action='store_true', dest='keeporig',
+                    default=False,
+                    help='Keep the originals of deleted pictures'),
+        make_option('--dry-run', action='store_true', dest='dryrun', default=False,
+                    help="Report what would be deleted, but don't"),
+        )
+    help = ('Delete media whose picture is gone or deleted, derived media for '
+            'an old orientation, chunks with no media and unreferenced files.')
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.verbose = int(options.get('verbosity', 1)) > 1
+        self.cutoff = datetime.now() - timedelta(minutes=options['grace'])
+
+        (count, freed) = self.sweep_media()
+        print 'media: %d deleted, %d bytes' % (count, freed)
+
+        (count, freed) = self.sweep_chunks()
+        print 'orphan chunks: %d media worth, %d bytes' % (count, freed)
+
+        for name in Media.objects.values('backend').distinct():
+            backend = get_backend(name['backend'])
+            if isinstance(backend, FileMediaBackend):
+                (count, freed) = self.sweep_files(backend)
+                print '%s: %d unreferenced files, %d bytes' % (name['backend'], count, freed)
+
+    def stale(self, m, pictures):
+        """ Return why m should go, or None if it should stay """
+        p = pictures.get(m.pictureid)
+        if p is None:
+            return 'no picture'
+        if p.deleted:
+            if m.variant == 'orig' and self.options['keeporig']:
+                return None
+            return 'picture deleted'
+        if m.orientation is not None and m.orientation != p.orientation:
+            return 'orientation %d, now %d' % (m.orientation, p.orientation)
+        return None
+
+    def sweep_media(self):
+        count = 0
+        freed = 0
+        lastid = 0
+        while True:
+            batch = Media.objects.filter(pictureid__isnull=False, id__gt=lastid,
+                                         update_time__lt=self.cutoff)
+            batch = list(batch.order_by('id')[:self.options['batch']])
+            if not batch:
+                break
+            lastid = batch[-1].id
+
+            ids = set([ m.pictureid for m in batch ])
+            pictures = dict([ (p.id, p) for p in
+                              Picture.all_objects.filter(id__in=list(ids)) ])
+
+            for m in batch:
+                why = self.stale(m, pictures)
+                if why is None:
+                    continue
+
+                if self.verbose:
+                    print 'media %d (%s): %s' % (m.id, m.key, why)
+                if not self.options['dryrun']:
+                    try:
+                        m.purge()
+                    except (MediaError, OSError, IOError), e:
+                        sys.stderr.write('media %d (%s): %s\n' % (m.id, m.key, e))
+                        continue
+                count += 1
+                freed += m.size
+
+        return (count, freed)
+
+    def sweep_chunks(self):
+        """ Delete chunks left behind by media which no longer exist """
+        qn = dbbackend.quote_name
+        chunks = MediaChunk._meta
+        media = Media._meta
+        mediaid = qn(chunks.get_field('media').column)
+
+        count = 0
+        freed = 0
+        cursor = connection.cursor()
+        while True:
+            cursor.execute('SELECT c.%s, SUM(LENGTH(c.%s)) FROM %s c LEFT JOIN %s m ON c.%s = m.%s'
+                           ' WHERE m.%s IS NULL GROUP BY c.%s LIMIT %d' %
+                           (mediaid, qn(chunks.get_field('data').column),
+                            qn(chunks.db_table), qn(media.db_table),
+                            mediaid, qn(media.pk.column), qn(media.pk.column),
+                            mediaid, self.options['batch']))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+
+            count += len(rows)
+            freed += sum([ int(size) for (id, size) in rows ])
+
+            if self.options['dryrun']:
+                break
+
+            cursor.execute('DELETE FROM %s WHERE %s IN (%s)' %
+                           (qn(chunks.db_table), mediaid,
+                            ', '.join([ '%s' ] * len(rows))),
+                           [ id for (id, size) in rows ])
+            transaction.commit_unless_managed()
+
+        return (count, freed)
+
+    def sweep_files(self, backend):
+        """ Delete files in a file backend which no media refers to """
+        store = backend.store
+        cutoff = time.time() - self.options['grace'] * 60
+
+        count = 0
+        freed = 0
+        for prefix in [ '%02x' % i for i in range(256) ]:
+            keys = [ key for (priv, key) in store.find(prefix) if priv == 'private' ]
+            if not keys:
+                continue
+
+            used = set()
+            for i in range(0, len(keys), self.options['batch']):
+                part = keys[i:i+self.options['batch']]
+                used.update([ m['sha1hash'] for m in
+                              Media.objects.filter(backend=backend.name,
+                                                   sha1hash__in=part).values('sha1hash') ])
+
+            for key in keys:
+                if key in used:
+                    continue
+
+                path = store.datapath(key, 'private')
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if st.st_mtime > cutoff:
+                    continue
+
+                if self.verbose:
+                    print '%s: unreferenced file %s' % (backend.name, key)
+                if not self.options['dryrun']:
+                    try:
+                        if not backend.discard(key, cutoff):
+                            continue    # shared by a new media since
+                    except OSError, e:
+                        sys.stderr.write('%s: %s: %s\n' % (backend.name, key, e))
+                        continue
+                count += 1
+                freed += st.st_size
+
+        return (count, freed)
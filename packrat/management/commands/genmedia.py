@@ -0,0 +1,164 @@
+from __future__ import absolute_import
+
+import os
+import sys
+import time
+import signal
+import traceback
+from datetime import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.db import connection, transaction
+
+from ...jobqueue import get_queue
+from ...keylock import KeyLock
+from ...media import MediaError
+from ...image import generate_all
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', default=2,
+                    help='Number of worker processes'),
+        make_option('--poll', type='float', default=5,
+                    help='Seconds to wait when the queue is empty'),
+        make_option('--once', action='store_true', default=False,
+                    help='Exit once the queue is empty'),
+        make_option('--stats', action='store_true', default=False,
+                    help='Show queue depth, throughput and failures, then exit'),
+        make_option('--retry', action='store_true', default=False,
+                    help='Give failed jobs another go, then exit'),
+        )
+    help = ('Run worker processes making the derived sizes queued for '
+            'newly uploaded pictures.')
+
+    def handle(self, *args, **options):
+        q = get_queue()
+        if q is None:
+            raise CommandError('PACKRAT_JOBQUEUE is not set')
+
+        if options['stats']:
+            self.stats(q)
+            return
+        if options['retry']:
+            q.retry()
+            return
+
+        self.once = options['once']
+        self.poll = options['poll']
+
+        # Don't touch the database before forking: the workers would
+        # share the connection
+        connection.close()
+
+        workers = {}
+        stopping = []
+        def stop(sig, frame):
+            stopping.append(sig)
+            for pid in workers:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        while True:
+            while not stopping and len(workers) < options['workers']:
+                pid = os.fork()
+                if pid == 0:
+                    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                    signal.signal(signal.SIGINT, signal.SIG_DFL)
+                    status = 0
+                    try:
+                        try:
+                            self.work(q)
+                        except:
+                            traceback.print_exc()
+                            status = 1
+                    finally:
+                        os._exit(status)
+                workers[pid] = True
+
+            if not workers:
+                break
+
+            try:
+                (pid, status) = os.wait()
+            except OSError:
+                continue                # interrupted by a signal
+            del workers[pid]
+            q.release(pid)
+
+            if status != 0 and not stopping:
+                sys.stderr.write('worker %d died (status %d)\n' % (pid, status))
+                time.sleep(1)           # don't spin if they all die at once
+            elif self.once:
+                stopping.append(None)
+
+    def work(self, q):
+        from ...picture import Picture
+
+        me = os.getpid()
+        while True:
+            job = q.take(me)
+            if job is None:
+                if self.once:
+                    return
+                time.sleep(self.poll)
+                continue
+
+            (pictureid, sizes) = job
+            start = time.time()
+
+            # End the last job's transaction, so this one reads afresh
+            # and sees pictures committed since
+            transaction.rollback_unless_managed()
+            try:
+                try:
+                    p = Picture.objects.get(id=pictureid)
+                except Picture.DoesNotExist, e:
+                    # its upload may not have committed yet
+                    q.wait(pictureid, sizes, '%s: %s' % (e.__class__.__name__, e))
+                    continue
+
+                # keep out of the way of requests making the same sizes
+                lock = KeyLock([ p.mediakey(s) for s in sizes ])
+                if not lock.acquire(settings.PACKRAT_GENERATE_TIMEOUT):
+                    raise MediaError('timed out waiting for lock')
+                try:
+                    have = [ m.variant for m in p.variants()
+                             if m.orientation == p.orientation ]
+                    generate_all(p, [ s for s in sizes if s not in have ])
+                finally:
+                    lock.release()
+            except Exception, e:
+                q.fail(pictureid, sizes, '%s: %s' % (e.__class__.__name__, e))
+                continue
+
+            q.done(pictureid, sizes, time.time() - start)
+
+    def stats(self, q):
+        now = time.time()
+
+        depth = q.depth()
+        print 'queue:'
+        if not depth:
+            print '  empty'
+        for (size, state, count, oldest) in depth:
+            print '  %-8s %-8s %6d  oldest %s' % (size, state, count,
+                                                  datetime.fromtimestamp(oldest))
+
+        print 'finished:'
+        for (name, period) in (('minute', 60), ('hour', 60 * 60), ('day', 24 * 60 * 60)):
+            (count, elapsed) = q.throughput(period)
+            print '  last %-6s %6d  (%.2f/s, %.3fs each)' % (name, count,
+                                                             count / float(period),
+                                                             elapsed or 0)
+
+        failures = q.failures()
+        if failures:
+            print 'failed:'
+        for (pictureid, size, tries, error) in failures:
+            print '  %d/%s after %d tries: %s' % (pictureid, size, tries, error)
@@ -0,0 +1,39 @@
+from __future__ import absolute_import
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from ...media import Media
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--batch', type='int', default=1000,
+                    help='Number of media updated at a time'),
+        )
+    help = ('Fill in the picture id, variant and orientation columns of '
+            'media stored before they existed (add the columns first with '
+            'sql/upgrade.mysql.sql).')
+
+    def handle(self, *args, **options):
+        count = 0
+        lastid = 0
+        while True:
+            batch = Media.objects.filter(pictureid__isnull=True, id__gt=lastid)
+            batch = list(batch.order_by('id')[:options['batch']])
+            if not batch:
+                break
+            lastid = batch[-1].id
+
+            for m in batch:
+                parsed = Media.parse_key(m.key)
+                if parsed is None:
+                    continue
+                (pictureid, variant, orientation) = parsed
+                m.update_fields(pictureid=pictureid, variant=variant,
+                                orientation=orientation)
+                count += 1
+
+            print '%d media indexed' % count
+
+        print 'done: %d media indexed' % count
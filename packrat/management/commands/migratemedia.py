@@ -0,0 +1,137 @@
+from __future__ import absolute_import
+
+import sys, os
+import threading
+import Queue
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from ...media import Media, MediaError, get_backend
+from .. import Throttle
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--from', dest='source', default='db',
+                    help='Backend to move media out of (default db)'),
+        make_option('--to', dest='dest', default='file',
+                    help='Backend to move media into (default file)'),
+        make_option('--workers', type='int', default=4,
+                    help='Number of media to move in parallel'),
+        make_option('--batch', type='int', default=100,
+                    help='Number of media per checkpointed batch'),
+        make_option('--checkpoint', default=None,
+                    help='File recording progress, so an interrupted run can resume'),
+        make_option('--rate', type='float', default=0,
+                    help='Limit on MB/s copied, to go easy on a live site'),
+        )
+    help = ('Move media data from one storage backend to another, checking '
+            'every sha1 hash on the way.  Safe to interrupt and rerun.')
+
+    def handle(self, *args, **options):
+        source = options['source']
+        dest = options['dest']
+        nworkers = options['workers']
+        batchsize = options['batch']
+        checkpoint = options['checkpoint']
+
+        if source == dest:
+            raise CommandError('source and destination backends are the same')
+        try:
+            get_backend(source)
+            get_backend(dest)
+        except MediaError, e:
+            raise CommandError(e.message)
+
+        throttle = Throttle(options['rate'] * 1024 * 1024)
+
+        lastid = 0
+        if checkpoint:
+            try:
+                lastid = int(file(checkpoint).read().strip() or 0)
+            except IOError:
+                pass
+
+        stats = { 'moved': 0, 'bytes': 0, 'failed': 0 }
+        statlock = threading.Lock()
+        queue = Queue.Queue(batchsize)
+
+        def worker():
+            try:
+                while True:
+                    id = queue.get()
+                    if id is None:
+                        queue.task_done()
+                        break
+                    try:
+                        self.move(id, source, dest, throttle, stats, statlock)
+                    finally:
+                        queue.task_done()
+            finally:
+                connection.close()
+
+        workers = [ threading.Thread(target=worker) for i in range(nworkers) ]
+        for w in workers:
+            w.setDaemon(True)
+            w.start()
+
+        try:
+            while True:
+                ids = Media.objects.filter(backend=source, id__gt=lastid)
+                ids = [ m['id'] for m in ids.order_by('id').values('id')[:batchsize] ]
+                if not ids:
+                    break
+
+                for id in ids:
+                    queue.put(id)
+                queue.join()
+
+                # Everything up to here has been dealt with, one way or another
+                lastid = ids[-1]
+                if checkpoint:
+                    f = file(checkpoint + '.tmp', 'w')
+                    f.write('%d\n' % lastid)
+                    f.close()
+                    os.rename(checkpoint + '.tmp', checkpoint)
+
+                print '%(moved)d moved (%(bytes)d bytes), %(failed)d failed' % stats
+        finally:
+            for w in workers:
+                queue.put(None)
+            for w in workers:
+                w.join()
+
+        print 'done: %(moved)d moved (%(bytes)d bytes), %(failed)d failed' % stats
+
+    def move(self, id, source, dest, throttle, stats, statlock):
+        try:
+            m = Media.objects.get(id=id)
+        except Media.DoesNotExist:
+            return
+
+        # someone else may have got there first
+        if m.backend != source:
+            return
+
+        try:
+            m.move(dest)
+            ok = True
+        except MediaError, e:
+            sys.stderr.write('%s\n' % e.message)
+            ok = False
+        except Exception, e:
+            sys.stderr.write('media %d (%s): %s\n' % (m.id, m.key, e))
+            ok = False
+
+        statlock.acquire()
+        try:
+            if ok:
+                stats['moved'] += 1
+                stats['bytes'] += m.size
+            else:
+                stats['failed'] += 1
+        finally:
+            statlock.release()
+
+        throttle.consume(m.size)
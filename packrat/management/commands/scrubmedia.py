@@ -0,0 +1,90 @@
+from __future__ import absolute_import
+
+import sys
+from datetime import datetime, timedelta
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from ...media import Media, MediaError
+from .. import Throttle
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--batch', type='int', default=100,
+                    help='Number of media fetched at a time'),
+        make_option('--rate', type='float', default=0,
+                    help='Limit on MB/s read, to go easy on a live site'),
+        make_option('--age', type='float', default=0,
+                    help='Only check media not verified for this many days'),
+        make_option('--repair', action='store_true', default=False,
+                    help='Repair corrupt media: drop cached copies, restore '
+                    'others from a good copy with the same hash'),
+        )
+    help = ('Reread every media, check its data against its sha1 hash, and '
+            'report (or repair) any which are corrupt.')
+
+    def handle(self, *args, **options):
+        batchsize = options['batch']
+        repair = options['repair']
+        throttle = Throttle(options['rate'] * 1024 * 1024)
+
+        query = Media.objects.all()
+        if options['age']:
+            cutoff = datetime.now() - timedelta(days=options['age'])
+            query = query.filter(Q(verified_time__isnull=True) |
+                                 Q(verified_time__lt=cutoff))
+
+        stats = { 'checked': 0, 'bytes': 0, 'corrupt': 0, 'repaired': 0 }
+        lastid = 0
+        while True:
+            batch = list(query.filter(id__gt=lastid).order_by('id')[:batchsize])
+            if not batch:
+                break
+            lastid = batch[-1].id
+
+            for m in batch:
+                stats['checked'] += 1
+                stats['bytes'] += m.size
+
+                if not m.verify():
+                    stats['corrupt'] += 1
+                    sys.stderr.write('media %d (%s): corrupt\n' % (m.id, m.key))
+
+                    try:
+                        if repair and self.repair(m):
+                            stats['repaired'] += 1
+                    except (MediaError, OSError, IOError), e:
+                        sys.stderr.write('media %d (%s): repair failed: %s\n' %
+                                         (m.id, m.key, e))
+
+                throttle.consume(m.size)
+
+            print ('%(checked)d checked (%(bytes)d bytes), %(corrupt)d corrupt, '
+                   '%(repaired)d repaired' % stats)
+
+        print ('done: %(checked)d checked (%(bytes)d bytes), %(corrupt)d corrupt, '
+               '%(repaired)d repaired' % stats)
+
+    def repair(self, m):
+        # Cached media can just be regenerated when next needed
+        if m.cache:
+            m.purge()
+            sys.stderr.write('media %d (%s): removed from cache\n' % (m.id, m.key))
+            return True
+
+        for good in Media.objects.filter(sha1hash=m.sha1hash).exclude(id=m.id):
+            if not good.verify():
+                continue
+            try:
+                m.repair(good)
+            except MediaError, e:
+                sys.stderr.write('%s\n' % e.message)
+                continue
+            sys.stderr.write('media %d (%s): repaired from media %d\n' %
+                             (m.id, m.key, good.id))
+            return True
+
+        sys.stderr.write('media %d (%s): no good copy to repair from\n' % (m.id, m.key))
+        return False
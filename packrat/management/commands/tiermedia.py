@@ -0,0 +1,96 @@
+from __future__ import absolute_import
+
+import sys
+from datetime import datetime, timedelta
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.db.models import Q
+
+from ...media import Media, MediaError
+from .. import Throttle
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--hot', default=None,
+                    help='Fast tier (default: where placement puts most variants)'),
+        make_option('--cold', default=None,
+                    help='Bulk tier (default: where placement puts originals)'),
+        make_option('--promote-hits', type='int', dest='hits', default=20,
+                    help='Move media used at least this often to the hot tier'),
+        make_option('--window', type='float', default=7,
+                    help='... provided it was used in the last this many days'),
+        make_option('--decay', type='float', default=0.5,
+                    help='Scale down hits by this after each run, so they '
+                    'count mostly recent use (1 to keep lifetime counts)'),
+        make_option('--max-size', type='int', dest='maxsize', default=4 * 1024 * 1024,
+                    help='Never promote media bigger than this many bytes'),
+        make_option('--idle', type='float', default=30,
+                    help='Move hot media unused for this many days to the cold tier'),
+        make_option('--batch', type='int', default=100,
+                    help='Number of media considered at a time'),
+        make_option('--rate', type='float', default=0,
+                    help='Limit on MB/s copied, to go easy on a live site'),
+        )
+    help = ('Move media between storage tiers: frequently used media to the '
+            'hot tier, idle media to the cold one.  Run it regularly (say '
+            'daily); each run decays the hit counts it goes by.')
+
+    def handle(self, *args, **options):
+        placement = settings.PACKRAT_MEDIA_PLACEMENT
+        hot = options['hot'] or placement['default']
+        cold = options['cold'] or placement.get('orig', placement['default'])
+
+        for t in (hot, cold):
+            if t not in settings.PACKRAT_MEDIA_TIERS:
+                raise CommandError("'%s' is not a storage tier" % t)
+        if hot == cold:
+            raise CommandError('hot and cold tiers are the same')
+
+        self.throttle = Throttle(options['rate'] * 1024 * 1024)
+        self.batchsize = options['batch']
+        now = datetime.now()
+
+        recent = now - timedelta(days=options['window'])
+        query = Media.objects.filter(backend=cold, hits__gte=options['hits'],
+                                     access_time__gte=recent,
+                                     size__lte=options['maxsize'])
+        (count, nbytes) = self.move(query, hot)
+        print 'promoted %d media (%d bytes) to %s' % (count, nbytes, hot)
+
+        idle = now - timedelta(days=options['idle'])
+        query = Media.objects.filter(Q(access_time__lt=idle) |
+                                     Q(access_time__isnull=True, update_time__lt=idle),
+                                     backend=hot)
+        (count, nbytes) = self.move(query, cold)
+        print 'demoted %d media (%d bytes) to %s' % (count, nbytes, cold)
+
+        # Otherwise media popular long ago would keep being promoted
+        if options['decay'] < 1:
+            Media.decay_hits(options['decay'])
+
+    def move(self, query, tier):
+        count = 0
+        nbytes = 0
+        lastid = 0
+        while True:
+            batch = list(query.filter(id__gt=lastid).order_by('id')[:self.batchsize])
+            if not batch:
+                break
+            lastid = batch[-1].id
+
+            for m in batch:
+                try:
+                    m.move(tier)
+                except MediaError, e:
+                    sys.stderr.write('%s\n' % e.message)
+                    continue
+                except (OSError, IOError), e:
+                    sys.stderr.write('media %d (%s): %s\n' % (m.id, m.key, e))
+                    continue
+                count += 1
+                nbytes += m.size
+                self.throttle.consume(m.size)
+
+        return (count, nbytes)
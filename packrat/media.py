@@ -1,63 +1,674 @@
 from __future__ import absolute_import
 
 import sha, md5
-from django.db import models
+import os, re
+import time
+from datetime import datetime, timedelta
+from django.db import models, connection, transaction
+from django.db import backend as dbbackend
+from django.conf import settings
+
+from .store import FileContentStore
+from .keylock import KeyLock
+from .lru import LRUCache
+
+class MediaError(Exception):
+    def __init__(self, msg):
+        self.message = msg
+
+def chunkify(data, chunksize):
+    """ Return an iterator which breaks data up into chunksize
+        pieces (the last may be short).  data may be a string, a
+        file-like object with a read() method, or an iterator
+        returning strings of any size.  Only about one chunk's worth
+        of data is buffered at a time. """
+    if isinstance(data, str):
+        for off in xrange(0, len(data), chunksize):
+            yield data[off:off+chunksize]
+        return
+
+    if hasattr(data, 'read'):
+        read = data.read
+        data = iter(lambda: read(chunksize), '')
+
+    pending = []
+    pendlen = 0
+    for d in data:
+        if not d:
+            continue
+        pending.append(d)
+        pendlen += len(d)
+
+        if pendlen >= chunksize:
+            buf = ''.join(pending)
+            off = 0
+            while pendlen - off >= chunksize:
+                yield buf[off:off+chunksize]
+                off += chunksize
+            pending = [ buf[off:] ]
+            pendlen -= off
+
+    if pendlen > 0:
+        yield ''.join(pending)
+
+def in_transaction(func):
+    """ Decorator to run func in its own transaction, committed on
+        success and rolled back on exception, unless the caller is
+        already managing a transaction, in which case it just becomes
+        part of that. """
+    def wrapper(*args, **kwargs):
+        if transaction.is_managed():
+            return func(*args, **kwargs)
+        return transaction.commit_on_success(func)(*args, **kwargs)
+
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+class ChunkWriter(object):
+    """ Collects MediaChunks for a Media object and writes them in
+        batches with a single multi-row INSERT, rather than a round
+        trip per chunk.  At most batchsize chunks are buffered. """
+
+    __slots__ = [ 'media', 'batchsize', 'pending' ]
+
+    def __init__(self, media, batchsize=None):
+        if batchsize is None:
+            batchsize = Media._batchsize
+
+        self.media = media
+        self.batchsize = batchsize
+        self.pending = []
+
+    def write(self, sequence, data):
+        self.pending.append((self.media.id, data, sequence))
+        if len(self.pending) >= self.batchsize:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        opts = MediaChunk._meta
+        qn = dbbackend.quote_name
+        cols = [ opts.get_field(f).column for f in ('media', 'data', 'sequence') ]
+
+        sql = 'INSERT INTO %s (%s) VALUES (%s)' % (qn(opts.db_table),
+                                                  ', '.join([ qn(c) for c in cols ]),
+                                                  ', '.join([ '%s' ] * len(cols)))
+
+        # MySQLdb turns executemany into one multi-row INSERT
+        cursor = connection.cursor()
+        cursor.executemany(sql, self.pending)
+        transaction.commit_unless_managed()
+
+        self.pending = []
+
+class MediaFile(object):
+    """ Read-only file object over a Media's data, for parsers which
+        seek about.  Only the chunks which are read are fetched, and
+        the last one is kept for the small reads that follow. """
+
+    __slots__ = [ 'media', 'pos', 'seq', 'chunk' ]
+
+    def __init__(self, media):
+        self.media = media
+        self.pos = 0
+        self.seq = None
+        self.chunk = ''
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.media.size
+        self.pos = max(offset, 0)
+
+    def tell(self):
+        return self.pos
+
+    def read(self, n=-1):
+        remain = self.media.size - self.pos
+        if n < 0 or n > remain:
+            n = remain
+        if n <= 0:
+            return ''
+
+        cs = Media._chunksize
+        if n > cs:
+            ret = ''.join(self.media.byterange(self.pos, self.pos + n - 1))
+            self.pos += len(ret)
+            return ret
+
+        ret = []
+        while n > 0:
+            seq = self.pos / cs
+            if seq != self.seq:
+                self.chunk = ''.join(self.media.chunks(seq, seq))
+                self.seq = seq
+            c = self.chunk[self.pos % cs:self.pos % cs + n]
+            if not c:
+                break
+            ret.append(c)
+            self.pos += len(c)
+            n -= len(c)
+        return ''.join(ret)
+
+class DBMediaBackend(object):
+    """ Keeps media data in the database as MediaChunk rows. """
+
+    def write(self, media, data, replace=False):
+        """ Write data for media, returning its (sha1hash, size).  The
+            media's old chunks must already have been deleted, so
+            replace makes no difference here. """
+        writer = ChunkWriter(media)
+        sha1 = sha.new()
+        size = 0
+        seq = 0
+        for c in chunkify(data, Media._chunksize):
+            #print 'storing key=%s seq=%d' % (media.key, seq)
+            sha1.update(c)
+            writer.write(seq, c)
+            size += len(c)
+            seq += 1
+        writer.flush()
+
+        return (sha1.digest().encode('hex'), size)
+
+    def chunks(self, media, first=0, last=None):
+        """ Chunks are fetched in sequence-ordered batches of
+            _readbatch, so only a few are ever in memory regardless of
+            how large the media is.  Nothing is read until the first
+            chunk is wanted, which raises MediaError if the data is
+            gone. """
+        seq = first
+        while True:
+            batch = self.batch(media, seq, last)
+            if not batch and seq == first and first < media.nchunks():
+                raise MediaError("media %d (%s): no data" % (media.id, media.key))
+            for c in batch:
+                yield c
+            seq += len(batch)
+
+            # a short batch means we've run out of chunks
+            if (last is not None and seq > last) or len(batch) < Media._readbatch:
+                break
+
+    def batch(self, media, seq, last):
+        end = seq + Media._readbatch
+        if last is not None:
+            end = min(end, last + 1)
+
+        batch = media.mediachunks.filter(sequence__gte=seq, sequence__lt=end)
+        return [ c['data'] for c in batch.order_by('sequence').values('data') ]
+
+    def exists(self, media):
+        if media.nchunks() == 0:
+            return True
+        return media.mediachunks.filter(sequence=0).count() > 0
+
+    def delete(self, media):
+        # Delete directly rather than have the ORM load every chunk
+        opts = MediaChunk._meta
+        qn = dbbackend.quote_name
+        cursor = connection.cursor()
+        cursor.execute('DELETE FROM %s WHERE %s = %%s' %
+                       (qn(opts.db_table), qn(opts.get_field('media').column)),
+                       [ media.id ])
+        transaction.commit_unless_managed()
+
+class FileMediaBackend(object):
+    """ Keeps media data in a FileContentStore, addressed by sha1 hash
+        so that identical data is only stored once.  The database only
+        holds the Media metadata. """
+
+    __slots__ = [ 'name', 'store' ]
+
+    _grace = 60 * 60                    # seconds a written file may await its media
+
+    def __init__(self, name, root, sync='always'):
+        self.name = name
+        self.store = FileContentStore(root, sync=sync)
+
+    def path(self, media):
+        return self.store.datapath(media.sha1hash, 'private')
+
+    def relpath(self, media):
+        """ Path of the media's data relative to the store root """
+        root = self.store.root('private')
+        return self.path(media)[len(root):].lstrip(os.sep)
+
+    def write(self, media, data, replace=False):
+        """ Write data for media, returning its (sha1hash, size).  If
+            a file with the same hash is already there it's shared,
+            unless replace is set, in which case it's overwritten: the
+            one there may be the damaged copy being repaired. """
+        (f, tmp) = self.store.tempfile()
+        try:
+            sha1 = sha.new()
+            size = 0
+            for c in chunkify(data, Media._chunksize):
+                sha1.update(c)
+                f.write(c)
+                size += len(c)
+            f.close()
+
+            hash = sha1.digest().encode('hex')
+            if not replace and self.freshen(hash):
+                os.unlink(tmp)
+            else:
+                self.store.adopt(tmp, hash, meta={ 'size': size })
+        except:
+            f.close()
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+        return (hash, size)
+
+    def freshen(self, hash):
+        """ Touch an existing file being shared with new media, so that
+            discard() leaves it alone until the new reference is
+            committed.  Returns False if there's no such file. """
+        lock = self.lock(hash)
+        try:
+            try:
+                os.utime(self.store.datapath(hash, 'private'), None)
+            except OSError:
+                return False
+            return True
+        finally:
+            lock.release()
+
+    def lock(self, hash):
+        """ Take the host-wide lock on the file for hash, which keeps
+            freshen() and discard() from overlapping """
+        lock = KeyLock('%s:%s' % (self.name, hash))
+        lock.acquire()
+        return lock
+
+    def discard(self, hash, cutoff=None):
+        """ Delete the file for hash, unless it has been written or
+            freshened since cutoff (a time.time(), by default _grace
+            ago): media sharing it may not be committed yet, and
+            gcmedia can have it later.  Returns whether it went. """
+        if cutoff is None:
+            cutoff = time.time() - self._grace
+
+        lock = self.lock(hash)
+        try:
+            try:
+                if os.stat(self.store.datapath(hash, 'private')).st_mtime > cutoff:
+                    return False
+            except OSError:
+                pass                    # already gone; tidy up the rest
+            self.store.delete(hash, 'private')
+            return True
+        finally:
+            lock.release()
+
+    def chunks(self, media, first=0, last=None):
+        """ The file is opened when the first chunk is wanted, which
+            raises MediaError if it is gone """
+        try:
+            f = file(self.path(media), 'rb')
+        except IOError, e:
+            raise MediaError("media %d (%s): %s" % (media.id, media.key, e))
+
+        try:
+            f.seek(first * Media._chunksize)
+            seq = first
+            while last is None or seq <= last:
+                d = f.read(Media._chunksize)
+                if not d:
+                    break
+                yield d
+                seq += 1
+        finally:
+            f.close()
+
+    def exists(self, media):
+        return os.path.exists(self.path(media))
+
+    def delete(self, media):
+        # Other media may share the same data, including ones being
+        # stored right now which we can't see yet; discard() allows
+        # for those
+        others = Media.objects.filter(backend=self.name, sha1hash=media.sha1hash)
+        if others.exclude(id=media.id).count() == 0:
+            self.discard(media.sha1hash)
+
+_backends = {}
+
+def get_backend(name):
+    """ Return the storage backend called name: 'db', 'file' or one of
+        the file storage tiers in settings.PACKRAT_MEDIA_TIERS """
+    if name not in _backends:
+        if name == 'db':
+            _backends[name] = DBMediaBackend()
+        elif name == 'file':
+            _backends[name] = FileMediaBackend(name, settings.PACKRAT_MEDIA_ROOT,
+                                               settings.PACKRAT_MEDIA_SYNC)
+        elif name in settings.PACKRAT_MEDIA_TIERS:
+            _backends[name] = FileMediaBackend(name, settings.PACKRAT_MEDIA_TIERS[name],
+                                               settings.PACKRAT_MEDIA_SYNC)
+        else:
+            raise MediaError("unknown media backend '%s'" % name)
+
+    return _backends[name]
+
+def placement(variant):
+    """ Return the name of the backend new media of variant should go
+        in: its tier if there are tiers, otherwise the default backend """
+    if not settings.PACKRAT_MEDIA_TIERS:
+        return settings.PACKRAT_MEDIA_BACKEND
+
+    rules = settings.PACKRAT_MEDIA_PLACEMENT
+    return rules.get(variant, rules['default'])
+
+# Recently used Media rows by key, shared by everything in the process
+media_cache = LRUCache(settings.PACKRAT_MEDIA_CACHE_SIZE,
+                       settings.PACKRAT_MEDIA_CACHE_TTL)
 
 class Media(models.Model):
     _chunksize = 64 * 1024
+    _batchsize = 4                      # chunks per INSERT; under 1MB even escaped
+    _readbatch = 8                      # chunks per SELECT when reading
+    _touchgrain = timedelta(minutes=1)  # how often to record accesses
 
     key = models.CharField(maxlength=128, db_index=True)
+
+    # The key broken out into columns (see Picture.mediakey()), with a
+    # composite index, so all the variants of a picture can be found
+    pictureid = models.PositiveIntegerField(null=True, blank=True)
+    variant = models.CharField(maxlength=16, blank=True)
+    orientation = models.PositiveSmallIntegerField(null=True, blank=True)
+
     sha1hash = models.CharField(maxlength=40, db_index=True)
     size = models.PositiveIntegerField()
     cache = models.BooleanField("temporary cache value")
     update_time = models.DateTimeField(auto_now=True)
+    backend = models.CharField("where the data is kept", maxlength=16, default='db')
+    verified_time = models.DateTimeField("when the data was last verified",
+                                         null=True, blank=True)
+    verified_sha1 = models.CharField("hash the data had when last verified",
+                                     maxlength=40, blank=True)
+    access_time = models.DateTimeField("when the data was last served",
+                                       null=True, blank=True, db_index=True)
+    hits = models.PositiveIntegerField("number of times served", default=0)
+
+    def update_fields(self, **kwargs):
+        """ Update just the given fields in the database, without
+            saving the whole row (and so without bumping update_time) """
+        opts = self._meta
+        qn = dbbackend.quote_name
+
+        items = kwargs.items()
+        sql = 'UPDATE %s SET %s WHERE %s = %%s' % (qn(opts.db_table),
+                                                 ', '.join([ '%s = %%s' % qn(opts.get_field(k).column)
+                                                             for (k,v) in items ]),
+                                                 qn(opts.pk.column))
+        cursor = connection.cursor()
+        cursor.execute(sql, [ v for (k,v) in items ] + [ self.id ])
+        transaction.commit_unless_managed()
+
+        for (k,v) in items:
+            setattr(self, k, v)
 
     def verify(self):
-        """Verify that the chunks for a particular hash are all present and correct"""
+        """Verify that the chunks for a particular hash are all present
+        and correct, and record the result"""
         sha1 = sha.new()
-        
-        for d in self.chunks.all():
-            sha1.update(d.data)
 
-        return sha1.digest().encode('hex') == self.sha1hash
+        try:
+            for d in self.chunks():
+                sha1.update(d)
+            ok = sha1.digest().encode('hex') == self.sha1hash
+        except MediaError:
+            ok = False
+
+        verified = ''
+        if ok:
+            verified = self.sha1hash
+        self.update_fields(verified_time=datetime.now(), verified_sha1=verified)
+
+        return ok
+
+    def touch(self):
+        """ Record that the media has been served.  To keep writes
+            down, accesses are only recorded once per _touchgrain, so
+            hits is a count of the periods it was in use (decayed by
+            decay_hits(), so that it's mostly recent ones). """
+        now = datetime.now()
+        if self.access_time is not None and now - self.access_time < Media._touchgrain:
+            return
 
-    def chunks(self):
-        return ( c.data for c in self.mediachunks.all() )
+        opts = self._meta
+        qn = dbbackend.quote_name
+        hits = qn(opts.get_field('hits').column)
+
+        cursor = connection.cursor()
+        cursor.execute('UPDATE %s SET %s = %s + 1, %s = %%s WHERE %s = %%s' %
+                       (qn(opts.db_table), hits, hits,
+                        qn(opts.get_field('access_time').column), qn(opts.pk.column)),
+                       [ now, self.id ])
+        transaction.commit_unless_managed()
+
+        self.access_time = now
+        self.hits += 1
+
+    @staticmethod
+    def decay_hits(factor):
+        """ Scale down every media's hits by factor, so that old use
+            counts for less than recent use """
+        opts = Media._meta
+        qn = dbbackend.quote_name
+        hits = qn(opts.get_field('hits').column)
+
+        cursor = connection.cursor()
+        cursor.execute('UPDATE %s SET %s = FLOOR(%s * %%s) WHERE %s > 0' %
+                       (qn(opts.db_table), hits, hits, hits), [ factor ])
+        transaction.commit_unless_managed()
+
+    def is_verified(self):
+        """ Return True if the data was good when last checked, without
+            reading it all again """
+        return self.sha1hash != '' and self.verified_sha1 == self.sha1hash
+
+    def nchunks(self):
+        return (self.size + Media._chunksize - 1) / Media._chunksize
+
+    _keyre = re.compile(r'^([0-9]+)/([a-z-]+)(?:\.([0-9]+))?$')
 
     @staticmethod
-    def get(key):
+    def parse_key(key):
+        """ Return (pictureid, variant, orientation) for a picture
+            media key, or None if it isn't one """
+        m = Media._keyre.match(key)
+        if m is None:
+            return None
+        (id, variant, orientation) = m.groups()
+        if orientation is not None:
+            orientation = int(orientation)
+        return (int(id), variant, orientation)
+
+    def save(self):
+        if self.pictureid is None:
+            parsed = Media.parse_key(self.key)
+            if parsed is not None:
+                (self.pictureid, self.variant, self.orientation) = parsed
+        super(Media, self).save()
+
+    def get_backend(self):
+        return get_backend(self.backend)
+
+    def chunks(self, first=0, last=None):
+        """ Return an iterator over the data of chunks first to last
+            (inclusive, defaulting to the end).  Nothing is read until
+            it's iterated over, which raises MediaError if the data is
+            gone; for a row from media_cache that may mean another
+            process has moved or deleted it since. """
+        return self.get_backend().chunks(self, first, last)
+
+    def exists(self):
+        """ Return whether the data is still there, without reading
+            any of it """
+        return self.get_backend().exists(self)
+
+    def open(self):
+        """ Return a read-only file object over the data """
+        return MediaFile(self)
+
+    def byterange(self, first, last):
+        """ Return an iterator over bytes first to last (inclusive).
+            Byte offsets map directly onto chunk sequence numbers, so
+            only the chunks covering the range are read. """
+        cs = Media._chunksize
+        return Media.trim(self.chunks(first / cs, last / cs),
+                          first % cs, last - first + 1)
+
+    @staticmethod
+    def trim(chunks, skip, remain):
+        for c in chunks:
+            c = c[skip:skip+remain]
+            skip = 0
+            remain -= len(c)
+            yield c
+
+    @staticmethod
+    def get(key, fresh=False):
+        """ Return the Media for key, or None.  Recently used ones come
+            from media_cache unless fresh is set. """
+        if not fresh:
+            ret = media_cache.get(key)
+            if ret is not None:
+                return ret
+
         try:
             ret = Media.objects.get(key=key)
         except Media.DoesNotExist:
-            ret = None
+            return None
+
+        media_cache.put(key, ret)
         return ret
     
     @staticmethod
-    def store(key, data, sha1hash=None, cache=False):
-        """Store a piece of data as media chunks"""
+    def variants(pictureids):
+        """ Return a dict mapping each of pictureids to a list of all
+            its stored variants, in one query.  The results also go
+            into media_cache. """
+        ret = dict([ (id, []) for id in pictureids ])
+        if not ret:
+            return ret
 
-        old = Media.get(key)
-        if old is not None:
-            if not old.verify():
-                old.chunks.delete()
-            else:
-                return old
-            
-        if sha1hash is None:
-            sha1 = sha.new(data)
-            sha1hash = sha1.digest().encode('hex')
+        for m in Media.objects.filter(pictureid__in=ret.keys()):
+            ret[m.pictureid].append(m)
+            media_cache.put(m.key, m)
+
+        return ret
+
+    @in_transaction
+    def move(self, backend):
+        """ Copy this media's data into another backend, checking it
+            against sha1hash, then switch over to it and delete the
+            old copy.  Raises MediaError if the data doesn't verify,
+            leaving the media as it was. """
+        if backend == self.backend:
+            return
+
+        old = self.get_backend()
+
+        (hash, size) = get_backend(backend).write(self, self.chunks())
+        if hash != self.sha1hash or size != self.size:
+            raise MediaError("media %d (%s) failed to verify: sha1 %s size %d, expected %s size %d" %
+                             (self.id, self.key, hash, size, self.sha1hash, self.size))
+
+        # not save(), which would bump update_time: the data hasn't changed
+        self.update_fields(backend=backend, verified_sha1=hash,
+                           verified_time=datetime.now())
+        media_cache.remove(self.key)
+
+        old.delete(self)
+
+    @in_transaction
+    def repair(self, good):
+        """ Replace this media's data with a copy from good, another
+            Media with the same hash which verifies. """
+        backend = self.get_backend()
+        backend.delete(self)
+
+        # the damaged file may be shared with other media, in which
+        # case delete() left it, so overwrite it
+        (hash, size) = backend.write(self, good.chunks(), replace=True)
+        if hash != self.sha1hash:
+            raise MediaError("media %d (%s): repair from media %d got sha1 %s, expected %s" %
+                             (self.id, self.key, good.id, hash, self.sha1hash))
 
-        media = Media(key=key, sha1hash=sha1hash, cache=cache, size=len(data))
+        self.update_fields(verified_time=datetime.now(), verified_sha1=hash)
+
+    def purge(self):
+        """ Delete this media along with its stored data """
+        media_cache.remove(self.key)
+        self.get_backend().delete(self)
+        self.delete()
+
+    @staticmethod
+    @in_transaction
+    def store(key, data, sha1hash=None, cache=False, backend=None):
+        """Store a piece of data as media.  data may be a string, a
+        file-like object or an iterator of strings; it is consumed and
+        written a chunk at a time, and the sha1 hash is computed as it
+        goes.  If sha1hash is given it must match the data.  backend
+        defaults to the placement() for the key's variant.  The whole store
+        is done in one transaction unless the caller already has one
+        open."""
+
+        if backend is None:
+            parsed = Media.parse_key(key)
+            backend = placement(parsed and parsed[1])
+
+        # Not through media_cache: this instance is about to become a
+        # placeholder, which nothing else should see
+        media_cache.remove(key)
+        try:
+            media = Media.objects.get(key=key)
+        except Media.DoesNotExist:
+            media = None
+
+        replace = False
+        if media is not None:
+            if media.is_verified() or media.verify():
+                return media
+            # damaged; its file may be shared, so overwrite it
+            media.get_backend().delete(media)
+            replace = True
+        else:
+            media = Media(key=key)
+
+        # Save an empty placeholder first so the chunks have
+        # something to refer to; it won't verify until it's complete
+        media.sha1hash = ''
+        media.verified_sha1 = ''
+        media.size = 0
+        media.cache = cache
+        media.backend = backend
         media.save()
-        
-        seq = 0
-        while len(data) > 0:
-            #print 'storing key=%s seq=%d' % (key, seq)
-            m = MediaChunk(media=media, sequence=seq,
-                           data=data[:Media._chunksize])
-            m.save()
-            data = data[Media._chunksize:]
-            seq += 1
+
+        (hash, size) = media.get_backend().write(media, data, replace=replace)
+        if sha1hash is not None and sha1hash != hash:
+            raise MediaError("sha1 mismatch storing '%s': expected %s, got %s" %
+                             (key, sha1hash, hash))
+
+        # it was hashed on the way in, so it's verified as written
+        media.sha1hash = hash
+        media.size = size
+        media.verified_sha1 = hash
+        media.verified_time = datetime.now()
+        media.save()
+
+        # drop anything cached from the database while this was going
+        # on; the next get() will pick it up once it's committed
+        media_cache.remove(key)
 
         return media
 
@@ -68,6 +679,6 @@ class MediaChunk(models.Model):
 
     class Meta:
         ordering = [ 'sequence' ]
-        unique_together = (('id', 'sequence'),)
+        unique_together = (('media', 'sequence'),)
 
-__all__ = [ 'Media' ]
+__all__ = [ 'Media', 'MediaError', 'get_backend', 'placement' ]
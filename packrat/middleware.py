@@ -0,0 +1,22 @@
+from __future__ import absolute_import
+
+from django.middleware.gzip import GZipMiddleware as DjangoGZipMiddleware
+
+class GZipMiddleware(DjangoGZipMiddleware):
+    """ Django's GZipMiddleware, but leaving alone pictures, which are
+        compressed already.  Gzipping reads the whole body into memory,
+        which would undo streaming them a chunk at a time; it would
+        also mangle partial (206) responses, and the empty ones the
+        front-end fills in with X-Sendfile. """
+
+    def process_response(self, request, response):
+        ctype = response.headers.get('Content-Type', '').lower()
+        if (response.status_code != 200 or
+            ctype.startswith('image/') or
+            ctype.startswith('multipart/byteranges') or
+            response.has_header('X-Sendfile') or
+            response.has_header('X-Accel-Redirect')):
+            return response
+        return DjangoGZipMiddleware.process_response(self, request, response)
+
+__all__ = [ 'GZipMiddleware' ]
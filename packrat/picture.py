@@ -1,6 +1,7 @@
 from __future__ import absolute_import
 
 import sha, md5
+import os
 import string, re
 import types
 from cStringIO import StringIO
@@ -8,6 +9,7 @@ import datetime as dt
 
 from django.db import models
 from django.db.models import permalink, Q
+from django.conf import settings
 from django.http import (HttpRequest, HttpResponse, HttpResponseRedirect,
                          HttpResponseForbidden, HttpResponseNotFound)
 from django.contrib.auth.models import User
@@ -17,13 +19,16 @@ from django import newforms as forms
 
 from ElementBuilder import Namespace, ElementTree
 
-from .media import Media
+from .media import Media, MediaError
+from .keylock import KeyLock
 from .tag import Tag, TagField
 from .rest import (RestBase, HttpResponseBadRequest,
                    HttpResponseConflict, HttpResponseBadRequest,
                    HttpResponseContinue, HttpResponseExpectationFailed,
-                   serialize_xml, serialize_ident, serialize_json)
-from . import EXIF, image, microformat, restlist
+                   HttpResponsePartialContent, HttpResponseRangeNotSatisfiable,
+                   HttpResponseServiceUnavailable,
+                   parse_range, serialize_xml, serialize_ident, serialize_json)
+from . import EXIF, image, jobqueue, microformat, restlist
 
 from .atomfeed import AtomFeed, AtomEntry, atomtime, atomperson
 from .restlist import Entry
@@ -76,6 +81,18 @@ class Picture(models.Model):
     def __init__(self, *args, **kwargs):
         self._camera_tags_query = None  # cache tags query
         super(Picture,self).__init__(*args, **kwargs)
+        self._orientation = self.orientation    # as stored
+
+    def save(self):
+        super(Picture,self).save()
+        if self._orientation is not None and self._orientation != self.orientation:
+            # only queues work; if even that fails, the new sizes are
+            # made as they're asked for, so don't fail the edit
+            try:
+                image.reorient(self, self._orientation)
+            except Exception, e:
+                print 'picture %d: reorient failed: %s' % (self.id, e)
+        self._orientation = self.orientation
 
     @staticmethod
     def str_visibility(v):
@@ -173,6 +190,11 @@ class Picture(models.Model):
     
     def media(self, variant='orig'):
         return Media.get(self.mediakey(variant))
+
+    def variants(self):
+        """ Return all the stored media for this picture, in any
+            orientation """
+        return Media.variants([ self.id ])[self.id]
     
     def image(self, size):
         return image.ImageProcessor(self, size)
@@ -379,10 +401,8 @@ def picture_upload(self, owner, **kwargs):
     p = image.importer(file, owner=owner, title=title,
                        original_ref=filename,
                        sha1hash=hash, visibility=Picture.PUBLIC,
-                       mimetype=type, **kwargs)
-
-    if 'tags' in request.POST:
-        p.add_tags(request.POST['tags'])
+                       mimetype=type, tags=request.POST.get('tags'),
+                       **kwargs)
 
     entry = PictureEntry(p, proto=self)
     
@@ -678,10 +698,11 @@ class PictureSizeList(restlist.Entry):
 class PictureImage(RestBase):
     """ Return the actual bits of a picture """
 
-    __slots__ = [ 'picture', 'size' ]
+    __slots__ = [ 'picture', 'size', 'medias' ]
     
     def __init__(self):
         self.size = None
+        self.medias = {}
         super(PictureImage, self).__init__()
 
         self.add_type('image', 'image/*', serialize_ident)
@@ -689,12 +710,19 @@ class PictureImage(RestBase):
         
     def urlparams(self, kwargs):
         self.picture = get_url_picture(self.authuser, kwargs)
-        
+        self.medias = {}
+
+    def media(self, size):
+        """ Look up the media for a size once per request """
+        if size not in self.medias:
+            self.medias[size] = self.picture.media(size)
+        return self.medias[size]
+
     def get_Etag(self):
         if self.size is None:
             return None
         
-        m = self.picture.media(self.size)
+        m = self.media(self.size)
         ret = None
         if m is not None:
             ret = '%s' % m.sha1hash
@@ -704,7 +732,7 @@ class PictureImage(RestBase):
         if self.size is None:
             return None
         
-        m = self.picture.media(self.size)
+        m = self.media(self.size)
         ret = None
         if m is not None:
             ret = m.size
@@ -715,13 +743,183 @@ class PictureImage(RestBase):
         if self.size is None:
             return None
         
-        m = self.picture.media(self.size)
+        m = self.media(self.size)
         ret = None
         if m is not None:
             ret = m.update_time
         #print '%d.%s = %s' % (self.picture.id, self.size, ret)
         return ret
     
+    def requested_ranges(self, m):
+        """ Return the list of byte ranges requested, [] if none of
+            them can be satisfied, or None if the whole image should be
+            returned. """
+        ranges = parse_range(self.request.META.get('HTTP_RANGE'), m.size)
+        if ranges is None:
+            return None
+
+        # If-Range: only send a partial response if the entity the
+        # client has is still current, by strong ETag or exact date
+        ifrange = self.request.META.get('HTTP_IF_RANGE')
+        if ifrange is not None:
+            if ifrange.startswith('"') or ifrange.startswith('W/'):
+                if ifrange != self.quoted_Etag():
+                    return None
+            else:
+                lm = self.get_last_modified()
+                if (lm is None or
+                    ifrange != lm.strftime('%a, %d %b %Y %H:%M:%S GMT')):
+                    return None
+
+        return ranges
+
+    def multipart_ranges(self, m, ranges, mimetype):
+        """ Build a multipart/byteranges response for several ranges """
+        boundary = os.urandom(12).encode('hex')
+
+        headers = [ '\r\n--%s\r\n'
+                    'Content-Type: %s\r\n'
+                    'Content-Range: bytes %d-%d/%d\r\n\r\n' %
+                    (boundary, mimetype, first, last, m.size)
+                    for (first, last) in ranges ]
+        trailer = '\r\n--%s--\r\n' % boundary
+
+        length = len(trailer)
+        for (h, (first, last)) in zip(headers, ranges):
+            length += len(h) + last - first + 1
+
+        # each part is only read (and opened) once the response gets
+        # to it
+        def body():
+            for (h, (first, last)) in zip(headers, ranges):
+                yield h
+                for c in m.byterange(first, last):
+                    yield c
+            yield trailer
+
+        ret = HttpResponsePartialContent(body(),
+                                         mimetype='multipart/byteranges; boundary=%s' % boundary)
+        ret['Content-Length'] = str(length)
+        return ret
+
+    def send_media(self, m, mimetype):
+        """ Return a response streaming the media's data, or just the
+            requested ranges of it """
+        ranges = self.requested_ranges(m)
+
+        if ranges is None:
+            ret = HttpResponse(m.chunks(), mimetype=mimetype)
+        elif not ranges:
+            ret = HttpResponseRangeNotSatisfiable(mimetype=mimetype)
+            ret['Content-Range'] = 'bytes */%d' % m.size
+            ret['Content-Length'] = '0'
+        elif len(ranges) == 1:
+            (first, last) = ranges[0]
+            ret = HttpResponsePartialContent(m.byterange(first, last),
+                                             mimetype=mimetype)
+            ret['Content-Range'] = 'bytes %d-%d/%d' % (first, last, m.size)
+            ret['Content-Length'] = str(last - first + 1)
+        else:
+            ret = self.multipart_ranges(m, ranges, mimetype)
+
+        ret['Accept-Ranges'] = 'bytes'
+
+        return ret
+
+    def sendfile(self, m, mimetype):
+        """ Return an empty response which tells the front-end web
+            server to send the media's file itself, either with
+            X-Sendfile (Apache, lighttpd) or X-Accel-Redirect (nginx).
+            The front-end also deals with any Range requests. """
+        backend = m.get_backend()
+        ret = HttpResponse(mimetype=mimetype)
+
+        if settings.PACKRAT_SENDFILE == 'x-accel-redirect':
+            ret['X-Accel-Redirect'] = '%s/%s/%s' % (settings.PACKRAT_SENDFILE_PREFIX.rstrip('/'),
+                                                    backend.name, backend.relpath(m))
+        else:
+            ret['X-Sendfile'] = backend.path(m)
+
+        return ret
+
+    def nearest_media(self, size):
+        """ Return the stored media nearest to size in the picture's
+            current orientation and the same shape, preferring bigger
+            to smaller, or None """
+        p = self.picture
+        (w, h, sq) = image.Image._sizes[size]
+
+        bigger = []
+        smaller = []
+        for m in p.variants():
+            if (m.orientation != p.orientation or m.variant in image.Image._originals or
+                m.variant not in image.Image._sizes):
+                continue
+            (mw, mh, msq) = image.Image._sizes[m.variant]
+            if msq != sq:
+                continue
+            if mw * mh >= w * h:
+                bigger.append((mw * mh, m))
+            else:
+                smaller.append((-mw * mh, m))
+
+        for l in (bigger, smaller):
+            if l:
+                l.sort()
+                return l[0][1]
+        return None
+
+    def serve(self, m, mimetype):
+        """ Return a response sending m, by sendfile if possible.
+            Raises MediaError if its data is gone; none of it is read
+            here, so a 304 or HEAD costs no more than that check. """
+        if not m.exists():
+            raise MediaError("media %d (%s): data missing" % (m.id, m.key))
+
+        backend = m.get_backend()
+        if settings.PACKRAT_SENDFILE and hasattr(backend, 'path'):
+            return self.sendfile(m, mimetype)
+        return self.send_media(m, mimetype)
+
+    def render_stale(self, proc):
+        """ Respond at once with the nearest stored size, or the
+            embedded thumbnail, in place of one which hasn't been made
+            yet, and queue that to be made.  The response may only be
+            cached briefly.  Returns None if there's nothing to stand
+            in, or no queue to make the real one. """
+        p = self.picture
+
+        m = self.nearest_media(self.size)
+        data = None
+        if m is None:
+            if proc is not None:
+                data = proc.placeholder()
+            if data is None:
+                return None
+
+        if not jobqueue.enqueue(p, [ self.size ]):
+            return None
+
+        self.format = 'image'
+        self.mimetype = 'image/jpeg'
+
+        if m is not None:
+            # headers describe what's actually sent
+            self.medias[self.size] = m
+            try:
+                ret = self.serve(m, 'image/jpeg')
+            except MediaError:
+                self.medias[self.size] = None
+                return None
+            m.touch()
+        else:
+            ret = HttpResponse(data, mimetype='image/jpeg')
+
+        ret['Cache-Control'] = 'max-age=%d' % settings.PACKRAT_STALE_MAX_AGE
+        ret['Content-Disposition'] = ('inline; filename="%d-%s.jpg"' %
+                                      (p.id, self.size))
+        return ret
+
     def render_image(self, *args, **kwargs):
         p = self.picture
 
@@ -731,24 +929,64 @@ class PictureImage(RestBase):
             size = 'orig'
 
         self.size = size
-        m = p.media(size)
+        m = self.media(size)
 
-        image = p.image(size)
-        
-        if m is None:
-            (m, type) = image.generate()
-            
-        if m is None:
+        if size not in image.Image._sizes:
             return HttpResponseNotFound('image %d has no size "%s"' % (p.id, size))
 
-        self.format = 'image'
-        self.mimetype = image.mimetype()
+        proc = p.image(size)
+        if proc is None:
+            return HttpResponseNotFound('image %d has no size "%s"' % (p.id, size))
 
-        ret = HttpResponse(m.chunks(), mimetype=image.mimetype())
+        if (m is None and settings.PACKRAT_STALE_WHILE_GENERATING and
+            size not in image.Image._originals):
+            ret = self.render_stale(proc)
+            if ret is not None:
+                return ret
 
-        # Make sure saving the image gives a useful filename
+        self.format = 'image'
+        self.mimetype = proc.mimetype()
+
+        for retry in (False, True):
+            if m is None:
+                # Only one request makes it; the others wait for that
+                lock = KeyLock(p.mediakey(size))
+                if not lock.acquire(settings.PACKRAT_GENERATE_TIMEOUT):
+                    ret = HttpResponseServiceUnavailable('image %d size "%s" is being made\n' %
+                                                         (p.id, size))
+                    ret['Retry-After'] = '%d' % settings.PACKRAT_GENERATE_TIMEOUT
+                    return ret
+                try:
+                    m = Media.get(p.mediakey(size), fresh=True)
+                    if m is None:
+                        (m, type) = proc.generate()
+                finally:
+                    lock.release()
+                self.medias[size] = m
+
+            if m is None:
+                return HttpResponseNotFound('image %d has no size "%s"' % (p.id, size))
+
+            try:
+                ret = self.serve(m, proc.mimetype())
+                break
+            except MediaError:
+                if retry:
+                    raise
+                # Another process may have moved or evicted it since
+                # it was cached; look again, and make it if it's gone
+                m = Media.get(p.mediakey(size), fresh=True)
+                self.medias[size] = m
+
+        m.touch()
+
+        # Make sure saving the image gives a useful filename; a turned
+        # copy of the original is a JPEG, whatever the original was
+        ext = proc.extension
+        if proc.mimetype() != p.mimetype:
+            ext = 'jpg'
         ret['Content-Disposition'] = ('inline; filename="%d-%s.%s"' %
-                                      (p.id, size, image.extension))
+                                      (p.id, size, ext))
 
         return ret
 
@@ -1150,7 +1388,7 @@ urlpatterns = \
            ('(?P<picid>[0-9]+)/exif/$',                                 pictureexif),
            ('(?P<picid>[0-9]+)/derived/(?:-/(?P<search>.*))?$',         picturederived),
            ('(?P<picid>[0-9]+)/pic/$',                                  picturesizelist),
-           ('(?P<picid>[0-9]+)/pic/(?P<size>[a-z]*)(?:\.[a-z]+)?/?$',   pictureimage),
+           ('(?P<picid>[0-9]+)/pic/(?P<size>[a-z-]*)(?:\.[a-z]+)?/?$',  pictureimage),
            ('(?P<picid>[0-9]+)/comment/$',                              commentfeed),
            ('(?P<picid>[0-9]+)/comment/(?P<commentid>[0-9]+)/?$',       comment),
            )
@@ -7,7 +7,7 @@ from datetime import datetime
 import urllib
 
 from django.http import HttpResponseNotAllowed, HttpResponse, HttpResponseNotFound
-from django.views.decorators.cache import cache_control
+from django.utils.cache import patch_cache_control
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist
 
@@ -16,7 +16,9 @@ from .namespace import html
 from . import json
 
 __all__ = [ 'RestBase', 'HttpResponseBadRequest', 'HttpResponseConflict',
-            'HttpResponseContinue', ]
+            'HttpResponseContinue', 'HttpResponsePartialContent',
+            'HttpResponseRangeNotSatisfiable', 'HttpResponseServiceUnavailable',
+            'parse_range' ]
 
 def serialize_xml(ret, file):
     ElementTree(ret).write(file, 'utf-8')
@@ -28,6 +30,78 @@ def serialize_json(ret, file):
 def serialize_ident(ret, file):
     file.write(ret)
 
+def default_cache_control(**kwargs):
+    """ Like django's cache_control decorator, but leaves alone
+    responses which have already set their own Cache-Control """
+    def decorator(fn):
+        def wrapper(*args, **kw):
+            response = fn(*args, **kw)
+            if not response.has_header('Cache-Control'):
+                patch_cache_control(response, **kwargs)
+            return response
+        return wrapper
+    return decorator
+
+def parse_range(header, length, maxranges=20):
+    """ Parse an HTTP Range header for an entity of length bytes.
+    Returns a sorted list of inclusive (first, last) byte offsets,
+    with overlapping and adjacent ranges merged, or None if the header
+    is absent or malformed, in which case it should be ignored and the
+    whole entity sent.  More than maxranges ranges is treated the same
+    way, rather than send lots of little parts.  An empty list means
+    none of the ranges are satisfiable. """
+    if not header:
+        return None
+
+    header = header.strip()
+    if not header.startswith('bytes='):
+        return None
+
+    ret = []
+    for spec in header[len('bytes='):].split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+
+        m = re.match('^([0-9]*)-([0-9]*)$', spec)
+        if m is None:
+            return None
+        first, last = m.groups()
+
+        if first == '':
+            # suffix range: the last N bytes
+            if last == '':
+                return None
+            last = int(last)
+            if last == 0:
+                continue
+            first = max(length - last, 0)
+            last = length - 1
+        else:
+            first = int(first)
+            if last == '':
+                last = length - 1
+            else:
+                last = int(last)
+                if last < first:
+                    return None
+                last = min(last, length - 1)
+
+        if first < length:
+            ret.append((first, last))
+
+    ret.sort()
+    merged = []
+    for (first, last) in ret:
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+
+    if len(merged) > maxranges:
+        return None
+    return merged
+
 class RestBase(object):
     """ Useful base class for RESTful apps, which demultiplexes a
     request based on its HTTP method.  Also provides a simple
@@ -240,12 +314,17 @@ class RestBase(object):
         response.content = ''
         response['Content-Length'] = '0'
 
-    def handle_cond_get(self, request, response):
-        # Handle ETag
+    def quoted_Etag(self):
+        """ Return the ETag as it appears in headers, or None """
         et = self.get_Etag()
         if et is not None:
             et = '"%s %s"' % (self.format, et)
-                
+        return et
+
+    def handle_cond_get(self, request, response):
+        # Handle ETag
+        et = self.quoted_Etag()
+        if et is not None:
             ifnm = request.META.get('HTTP_IF_NONE_MATCH', None)
             if ifnm is not None:
                 ifnm = re.split(', *', ifnm)
@@ -270,7 +349,7 @@ class RestBase(object):
         ser(body, response)
         return response
 
-    @cache_control(no_cache=True)
+    @default_cache_control(no_cache=True)
     def __call__(self, request, *args, **kwargs):
         """ Main entrypoint for all requests.  This allows the class
         instance to be called.  In turn, it examines the HTTP method,
@@ -323,6 +402,16 @@ class RestBase(object):
 
         return response
 
+class HttpResponsePartialContent(HttpResponse):
+    def __init__(self, *args, **kwargs):
+        HttpResponse.__init__(self, *args, **kwargs)
+        self.status_code = 206
+
+class HttpResponseRangeNotSatisfiable(HttpResponse):
+    def __init__(self, *args, **kwargs):
+        HttpResponse.__init__(self, *args, **kwargs)
+        self.status_code = 416
+
 class HttpResponseBadRequest(HttpResponse):
     def __init__(self, *args, **kwargs):
         HttpResponse.__init__(self, *args, **kwargs)
@@ -343,6 +432,11 @@ class HttpResponseExpectationFailed(HttpResponse):
         HttpResponse.__init__(self, *args, **kwargs)
         self.status_code = 417
 
+class HttpResponseServiceUnavailable(HttpResponse):
+    def __init__(self, *args, **kwargs):
+        HttpResponse.__init__(self, *args, **kwargs)
+        self.status_code = 503
+
 
 
 class Test(RestBase):
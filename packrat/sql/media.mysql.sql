@@ -0,0 +1,2 @@
+CREATE INDEX packrat_media_variant ON packrat_media (pictureid, variant, orientation);
+ALTER TABLE packrat_media ENGINE = InnoDB;
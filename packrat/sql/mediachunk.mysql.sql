@@ -1,2 +1,3 @@
 ALTER TABLE imagestore_mediachunk AVG_ROW_LENGTH = 65536, MAX_ROWS=1000000;
 ALTER TABLE imagestore_mediachunk MODIFY COLUMN data LONGBLOB NOT NULL;
+ALTER TABLE packrat_mediachunk ENGINE = InnoDB;
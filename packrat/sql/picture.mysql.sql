@@ -1 +1,3 @@
 ALTER TABLE imagestore_picture     CONVERT TO CHARACTER SET utf8 COLLATE utf8_general_ci;
+ALTER TABLE packrat_picture ENGINE = InnoDB;
+ALTER TABLE packrat_picture_tags ENGINE = InnoDB;
@@ -1 +1,2 @@
 ALTER TABLE imagestore_tag         CONVERT TO CHARACTER SET utf8 COLLATE utf8_general_ci;
+ALTER TABLE packrat_tag ENGINE = InnoDB;
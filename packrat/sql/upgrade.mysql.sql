@@ -0,0 +1,28 @@
+-- Bring tables made by an older packrat up to date, by hand; syncdb
+-- only creates missing tables.  Then run indexmedia to fill in
+-- pictureid, variant and orientation.
+ALTER TABLE packrat_media
+    ADD COLUMN pictureid integer UNSIGNED NULL,
+    ADD COLUMN variant varchar(16) NOT NULL DEFAULT '',
+    ADD COLUMN orientation smallint UNSIGNED NULL,
+    ADD COLUMN backend varchar(16) NOT NULL DEFAULT 'db',
+    ADD COLUMN verified_time datetime NULL,
+    ADD COLUMN verified_sha1 varchar(40) NOT NULL DEFAULT '',
+    ADD COLUMN access_time datetime NULL,
+    ADD COLUMN hits integer UNSIGNED NOT NULL DEFAULT 0;
+CREATE INDEX packrat_media_access_time ON packrat_media (access_time);
+CREATE INDEX packrat_media_variant ON packrat_media (pictureid, variant, orientation);
+
+-- Fails if any media has two chunks with the same sequence; remove
+-- the duplicates first.
+ALTER TABLE packrat_mediachunk ADD UNIQUE (media_id, sequence);
+
+-- Uploads, media stores and moves rely on transactions to leave
+-- nothing half done, which MyISAM tables don't have.  Converting
+-- packrat_mediachunk copies every chunk, so allow for the time and
+-- space that takes.
+ALTER TABLE packrat_picture ENGINE = InnoDB;
+ALTER TABLE packrat_picture_tags ENGINE = InnoDB;
+ALTER TABLE packrat_tag ENGINE = InnoDB;
+ALTER TABLE packrat_media ENGINE = InnoDB;
+ALTER TABLE packrat_mediachunk ENGINE = InnoDB;
@@ -2,9 +2,17 @@ from __future__ import absolute_import
 
 import sha, md5
 import os, os.path
-import glob
+import errno
+import tempfile
+import threading
+import time
 import cPickle as pickle
 
+try:
+    import sqlite3
+except ImportError:
+    from pysqlite2 import dbapi2 as sqlite3
+
 class Content(object):
     __slots__ = [ 'store', 'key', 'priv', 'meta' ]
     
@@ -26,6 +34,232 @@ class ContentStore(object):
     def read(self, key):
         pass
 
+class KeyIndex(object):
+    """ Sorted index of the keys in a FileContentStore along with
+        their metadata, kept in a small SQLite database.  Prefix
+        searches are a range lookup rather than a directory scan, and
+        metadata for many keys can be read in a few queries.
+
+        Updates are committed straight away unless inside begin() /
+        commit(), which batches them into a single transaction. """
+
+    __slots__ = [ 'path', 'local' ]
+
+    _maxvars = 500                      # keys per IN (...) query
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def db(self):
+        # SQLite connections can't be shared between threads
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.text_factory = str
+            db.execute('CREATE TABLE IF NOT EXISTS content ('
+                       ' key TEXT PRIMARY KEY,'
+                       ' priv TEXT NOT NULL,'
+                       ' meta BLOB)')
+            cols = [ r[1] for r in db.execute('PRAGMA table_info(content)') ]
+            if 'meta' not in cols:
+                db.execute('ALTER TABLE content ADD COLUMN meta BLOB')
+            db.commit()
+            self.local.db = db
+            self.local.depth = 0
+        return db
+
+    def begin(self):
+        self.db()
+        self.local.depth += 1
+
+    def commit(self):
+        self.local.depth -= 1
+        self.changed()
+
+    def changed(self):
+        if self.local.depth == 0:
+            self.db().commit()
+
+    @staticmethod
+    def pickle(meta):
+        if meta is None:
+            return None
+        return sqlite3.Binary(pickle.dumps(meta, 2))
+
+    @staticmethod
+    def unpickle(meta):
+        if meta is None:
+            return None
+        return pickle.loads(str(meta))
+
+    def add(self, key, priv, meta=None):
+        self.db().execute('INSERT OR REPLACE INTO content (key, priv, meta)'
+                          ' VALUES (?, ?, ?)', (key, priv, self.pickle(meta)))
+        self.changed()
+
+    def setpriv(self, key, priv):
+        self.db().execute('UPDATE content SET priv = ? WHERE key = ?', (priv, key))
+        self.changed()
+
+    def setmeta(self, key, meta):
+        self.db().execute('UPDATE content SET meta = ? WHERE key = ?',
+                          (self.pickle(meta), key))
+        self.changed()
+
+    def remove(self, key):
+        self.db().execute('DELETE FROM content WHERE key = ?', (key,))
+        self.changed()
+
+    def getmeta(self, key):
+        """ Return (present, meta) for key """
+        r = self.db().execute('SELECT meta FROM content WHERE key = ?', (key,)).fetchone()
+        if r is None:
+            return (False, None)
+        return (True, self.unpickle(r[0]))
+
+    def getmetas(self, keys):
+        """ Return a dict of key -> meta for those keys which are present """
+        keys = list(keys)
+        ret = {}
+        for i in range(0, len(keys), self._maxvars):
+            part = keys[i:i+self._maxvars]
+            c = self.db().execute('SELECT key, meta FROM content WHERE key IN (%s)' %
+                                  ', '.join([ '?' ] * len(part)), part)
+            for (k, m) in c:
+                ret[k] = self.unpickle(m)
+        return ret
+
+    def find(self, keyprefix):
+        """ Return a sorted list of (priv, key) for keys starting with keyprefix """
+        if keyprefix:
+            # everything from the prefix up to the next possible prefix
+            end = keyprefix[:-1] + chr(ord(keyprefix[-1]) + 1)
+            c = self.db().execute('SELECT priv, key FROM content'
+                                  ' WHERE key >= ? AND key < ? ORDER BY key',
+                                  (keyprefix, end))
+        else:
+            c = self.db().execute('SELECT priv, key FROM content ORDER BY key')
+        return c.fetchall()
+
+    def rebuild(self, store):
+        """ Bring the index up to date with what's actually in store,
+            keeping existing metadata and picking up any old per-file
+            __meta pickles. """
+        self.begin()
+        try:
+            db = self.db()
+            present = set()
+            for priv in ('public', 'private'):
+                top = os.path.join(store.root(priv), priv)
+                for (dirpath, dirnames, filenames) in os.walk(top):
+                    if 'data' not in filenames:
+                        continue
+                    del dirnames[:]
+
+                    key = os.path.basename(dirpath)
+                    present.add(key)
+
+                    db.execute('INSERT OR IGNORE INTO content (key, priv) VALUES (?, ?)',
+                               (key, priv))
+                    db.execute('UPDATE content SET priv = ? WHERE key = ?', (priv, key))
+
+                    if '__meta' in filenames:
+                        meta = pickle.load(file(os.path.join(dirpath, '__meta'), 'rb'))
+                        db.execute('UPDATE content SET meta = ? WHERE key = ? AND meta IS NULL',
+                                   (self.pickle(meta), key))
+
+            gone = [ k for (k,) in db.execute('SELECT key FROM content') if k not in present ]
+            for k in gone:
+                db.execute('DELETE FROM content WHERE key = ?', (k,))
+        finally:
+            self.commit()
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class GroupCommit(object):
+    """ Lets concurrent writers share the cost of making their writes
+        durable.  Each writer calls run() with a list of items, and is
+        blocked until they are done.  The first to arrive becomes the
+        leader, and calls fn just once with the items of everyone in
+        its group.  If others have joined already, it waits a short
+        window for more first; a writer on its own doesn't wait.
+
+        Only threads within one process share groups. """
+
+    __slots__ = [ 'fn', 'window', 'cond', 'pending', 'members', 'leader',
+                  'forming', 'done', 'error' ]
+
+    def __init__(self, fn, window=0.01):
+        self.fn = fn
+        self.window = window
+        self.cond = threading.Condition()
+        self.pending = []
+        self.members = 0                # writers in the forming group
+        self.leader = False
+        self.forming = 0                # group currently taking members
+        self.done = -1                  # last group finished
+        self.error = None               # (group, exception) of last failure
+
+    def run(self, items):
+        self.cond.acquire()
+        try:
+            self.pending.extend(items)
+            self.members += 1
+            mine = self.forming
+
+            while True:
+                if self.done >= mine:
+                    if self.error is not None and self.error[0] == mine:
+                        raise self.error[1]
+                    return
+                if not self.leader:
+                    self.leader = True
+                    break
+                self.cond.wait()
+
+            crowd = self.members > 1
+        finally:
+            self.cond.release()
+
+        # We're the leader: if there are others about, let the group
+        # fill up, then do it
+        if crowd:
+            time.sleep(self.window)
+
+        self.cond.acquire()
+        try:
+            group = self.forming
+            self.forming += 1
+            self.members = 0
+            (items, self.pending) = (self.pending, [])
+        finally:
+            self.cond.release()
+
+        error = None
+        try:
+            self.fn(items)
+        except Exception, e:
+            error = e
+
+        self.cond.acquire()
+        try:
+            self.done = group
+            if error is not None:
+                self.error = (group, error)
+            self.leader = False
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+        if error is not None:
+            raise error
+
 class FileContent(Content):
     def __init__(self, store, key, priv):
         super(FileContent, self).__init__(store, key, priv)
@@ -40,14 +274,19 @@ class FileContent(Content):
         return file(self.datapath(), 'rb').read()
 
     def readmeta(self):
-        return pickle.load(file(self.metapath(), 'rb'))
+        (present, meta) = self.store.index.getmeta(self.key)
+        if meta is None and os.path.exists(self.metapath()):
+            # left over from before metadata was in the index
+            meta = pickle.load(file(self.metapath(), 'rb'))
+        return meta
         
     def writemeta(self, meta):
-        pickle.dump(meta, file(self.metapath(), 'wb'), 2)
+        self.store.index.setmeta(self.key, meta)
                     
     def url(self):
         if self.store.puburl and self.priv == 'public':
-            return '%s/%s/data' % (self.store.puburl, self.key)
+            return '%s/%s/data' % (self.store.puburl,
+                                   '/'.join(self.store.fan(self.key) + [ self.key ]))
 
         return None
 
@@ -55,37 +294,72 @@ class FileContent(Content):
         assert priv in ('public', 'private')
 
         old = self.store.path(self.key, self.priv)
+        new = self.store.path(self.key, priv)
+
+        # A single rename of the key's directory, so the content is
+        # always wholly in one place or the other
+        dirs = self.store.makedirs(os.path.dirname(new))
+        os.rename(old, new)
+        self.store.sync(dirs=dirs + [ os.path.dirname(old) ])
+
         self.priv = priv
-        new = self.store.path(self.key, self.priv)
-        os.renames(old, new)
+        self.store.index.setpriv(self.key, self.priv)
 
 class FileContentStore(ContentStore):
-    __slots__ = [ 'pubroot', 'privroot' ]
+    __slots__ = [ 'pubroot', 'privroot', 'puburl', 'fanout', 'index',
+                  'syncmode', 'group', 'local' ]
     
-    def __init__(self, pubroot, privroot=None, puburl=None):
+    def __init__(self, pubroot, privroot=None, puburl=None, fanout=2,
+                 sync='always'):
+        """ fanout is the number of levels of two-character
+            subdirectories, taken from the start of the key, used to
+            spread keys (typically hashes) across directories.  An
+            index of all the keys is kept in privroot/index.db.
+
+            Content is written to a temporary file and renamed into
+            place, so it's never seen half-written.  sync says how it
+            is made durable: 'always' fsyncs every write, 'group'
+            shares the fsyncs and the index commit between writers in
+            concurrent threads, and 'none' leaves it to the OS. """
+        assert sync in ('always', 'group', 'none')
+
         if privroot is None:
             privroot = pubroot
 
         self.pubroot = pubroot
         self.privroot = privroot
         self.puburl = puburl
+        self.fanout = fanout
+        self.syncmode = sync
+        self.group = None
+        if sync == 'group':
+            self.group = GroupCommit(self.settle)
+        self.local = threading.local()
 
-    def path(self, key, priv):
+        if not os.path.isdir(privroot):
+            os.makedirs(privroot)
+
+        indexpath = os.path.join(privroot, 'index.db')
+        new = not os.path.exists(indexpath)
+        self.index = KeyIndex(indexpath)
+        if new:
+            self.index.rebuild(self)
+
+    def root(self, priv):
         assert priv in ('public', 'private')
-        
-        root = self.privroot
+
         if priv == 'public':
-            root = self.pubroot
+            return self.pubroot
+        return self.privroot
 
-        return os.path.join(root, priv, key)
+    def fan(self, key):
+        return [ key[i*2:i*2+2] for i in range(self.fanout) ]
 
-    def find(self, keyprefix):
-        pub = [ ('public', os.path.basename(pub)) for pub in
-                glob.glob('%s/public/%s*' % (self.pubroot, keyprefix)) ]
-        priv = [ ('private', os.path.basename(priv)) for priv in
-                glob.glob('%s/private/%s*' % (self.pubroot, keyprefix)) ]
+    def path(self, key, priv):
+        return os.path.join(self.root(priv), priv, *(self.fan(key) + [ key ]))
 
-        return pub + priv
+    def find(self, keyprefix):
+        return self.index.find(keyprefix)
 
     def datapath(self, key, priv):
         return os.path.join(self.path(key, priv), 'data')
@@ -96,17 +370,121 @@ class FileContentStore(ContentStore):
     def exists(self, key, priv):
         return os.path.exists(self.path(key, priv))
 
-    def create(self, key, data, meta=None, priv='private', cache=False):
-        path = self.path(key, priv)
-        if not os.path.exists(path):
-            os.makedirs(path)
-            
-        file(self.datapath(key, priv), 'wb').write(data)
+    def sync(self, files=(), dirs=()):
+        """ Make sure files and dirs are on disk, unless the store's
+            sync mode is 'none' """
+        if self.syncmode != 'none':
+            for p in list(files) + list(dirs):
+                fsync_path(p)
 
-        ret = self.get(key, priv)
-        ret.writemeta(meta)
+    def makedirs(self, path):
+        """ Make path and any missing parents, returning the
+            directories whose entries changed and need syncing """
+        ret = [ path ]
+        while not os.path.isdir(path):
+            ret.append(os.path.dirname(path))
+            path = os.path.dirname(path)
 
+        if len(ret) > 1:
+            os.makedirs(ret[0])
         return ret
+
+    def create(self, key, data, meta=None, priv='private', cache=False):
+        (f, tmp) = self.tempfile(priv)
+        try:
+            f.write(data)
+        finally:
+            f.close()
+
+        return self.adopt(tmp, key, meta, priv)
+
+    def tempfile(self, priv='private'):
+        """ Return an open (file, name) for a temporary file within
+            the store, so that it can be adopted by a rename. """
+        tmpdir = os.path.join(self.root(priv), 'tmp')
+        if not os.path.exists(tmpdir):
+            os.makedirs(tmpdir)
+
+        (fd, name) = tempfile.mkstemp(dir=tmpdir)
+        return (os.fdopen(fd, 'wb'), name)
+
+    def adopt(self, tmpname, key, meta=None, priv='private'):
+        """ Create key with the contents of tmpname, which must be
+            from tempfile(priv) and closed.  Inside begin()/commit() the
+            content only appears when the batch is committed. """
+        item = (tmpname, key, meta, priv)
+        if getattr(self.local, 'depth', 0) > 0:
+            self.local.pending.append(item)
+        elif self.group is not None:
+            self.group.run([ item ])
+        else:
+            self.settle([ item ])
+
+        return self.get(key, priv)
+
+    def settle(self, pending):
+        """ Sync, install and index a list of (tmpname, key, meta,
+            priv) from adopt(), with one sync of all their files, one
+            of all their directories and a single index commit """
+        self.sync(files=[ p[0] for p in pending ])
+        dirs = set()
+        for (tmpname, key, meta, priv) in pending:
+            dirs.update(self.install(tmpname, key, priv))
+        self.sync(dirs=dirs)
+
+        self.index.begin()
+        try:
+            for (tmpname, key, meta, priv) in pending:
+                self.index.add(key, priv, meta)
+        finally:
+            self.index.commit()
+
+    def install(self, tmpname, key, priv):
+        """ Rename tmpname into place as key, returning the
+            directories which need syncing """
+        dirs = self.makedirs(self.path(key, priv))
+        os.rename(tmpname, self.datapath(key, priv))
+        return dirs
+
+    def delete(self, key, priv):
+        # Parts of it already being gone is fine; a missing file is
+        # often why it's being deleted
+        for p in (self.datapath(key, priv), self.metapath(key, priv)):
+            try:
+                os.unlink(p)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+        try:
+            os.rmdir(self.path(key, priv))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        self.index.remove(key)
         
     def get(self, key, priv):
         return FileContent(self, key, priv)
+
+    def readmeta(self, keys):
+        """ Return a dict of key -> metadata for many keys at once """
+        return self.index.getmetas(keys)
+
+    def begin(self):
+        """ Start a batch of writes.  New content is synced and
+            installed, and the index updated, all in one go by the
+            matching commit(), so a bulk load pays for a few syncs
+            rather than one per file. """
+        if getattr(self.local, 'depth', 0) == 0:
+            self.local.depth = 0
+            self.local.pending = []
+        self.local.depth += 1
+        self.index.begin()
+
+    def commit(self):
+        self.local.depth -= 1
+        try:
+            if self.local.depth == 0 and self.local.pending:
+                (pending, self.local.pending) = (self.local.pending, [])
+                self.settle(pending)
+        finally:
+            self.index.commit()
@@ -58,7 +58,7 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
-    'django.middleware.gzip.GZipMiddleware',
+    'packrat.middleware.GZipMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -82,3 +82,65 @@ INSTALLED_APPS = (
     'django.contrib.sites',
     'packrat',
 )
+
+# Where packrat keeps picture data: 'db' stores it as MediaChunk rows,
+# 'file' in a content-addressed store under PACKRAT_MEDIA_ROOT.
+PACKRAT_MEDIA_BACKEND = 'db'
+PACKRAT_MEDIA_ROOT = ''
+# How file-backed media is made durable: 'always' fsyncs every file,
+# 'group' shares fsyncs between concurrent writers, 'none' doesn't.
+# Only threads in one process share, so 'group' helps threaded servers
+# and migratemedia's workers, not prefork ones.
+PACKRAT_MEDIA_SYNC = 'always'
+# Storage tiers for file-backed media: a map of tier name to root
+# directory, e.g. { 'hot': '/srv/ssd/packrat', 'bulk': '/srv/bulk/packrat' }.
+# If there are any, new media goes to the tier PACKRAT_MEDIA_PLACEMENT
+# gives for its variant (or its 'default'), and the tiermedia command
+# moves media between them according to use.
+PACKRAT_MEDIA_TIERS = {}
+PACKRAT_MEDIA_PLACEMENT = {
+    'orig':     'bulk',
+    'full':     'bulk',
+    'huge':     'bulk',
+    'orig-rotated': 'bulk',
+    'default':  'hot',
+    }
+# Per-process cache of Media rows: how many, and for how many seconds
+# (other processes' changes are only seen once an entry expires)
+PACKRAT_MEDIA_CACHE_SIZE = 10000
+PACKRAT_MEDIA_CACHE_TTL = 60
+
+# Let the front-end web server send file-backed media itself:
+# None, 'x-sendfile' (Apache/lighttpd) or 'x-accel-redirect' (nginx).
+# For nginx, PACKRAT_SENDFILE_PREFIX is the internal location under
+# which each file backend's root is mapped by name, e.g. /packrat-media/file/
+# onto PACKRAT_MEDIA_ROOT and /packrat-media/hot/ onto the 'hot' tier.
+PACKRAT_SENDFILE = None
+PACKRAT_SENDFILE_PREFIX = '/packrat-media'
+
+# Bytes of cached derived images to keep; see the evictmedia command
+PACKRAT_CACHE_BUDGET = 10 * 1024 * 1024 * 1024
+
+# SQLite database holding the queue of derived sizes to make for newly
+# uploaded pictures ('' to make them only when first asked for), and
+# which sizes to queue, in groups from most to least urgent.  The
+# genmedia command runs the workers.
+PACKRAT_JOBQUEUE = ''
+PACKRAT_PREGENERATE = (
+    ('icon', 'stamp', 'thumb'),
+    ('tiny', 'small'),
+    ('medium', 'large'),
+    )
+
+# Lock files making sure only one process on the host generates any
+# one media at a time ('' for a directory under /tmp), and how many
+# seconds a request waits for someone else's before giving up with 503.
+PACKRAT_LOCK_DIR = ''
+PACKRAT_GENERATE_TIMEOUT = 30
+
+# Rather than making a request wait while a size is generated, answer
+# straight away with the nearest size already stored (or the embedded
+# Exif thumbnail), cacheable for only PACKRAT_STALE_MAX_AGE seconds,
+# and queue the real one.  Needs PACKRAT_JOBQUEUE and genmedia workers.
+PACKRAT_STALE_WHILE_GENERATING = False
+PACKRAT_STALE_MAX_AGE = 10